@@ -33,18 +33,31 @@ from vminspect.usnjrnl import usn_journal
 from vminspect.winevtx import WinEventLog
 from vminspect.vulnscan import VulnScanner
 from vminspect.filesystem import FileSystem
-from vminspect.comparator import DiskComparator
+from vminspect.appliance import AppliancePool
+from vminspect.cache import ManifestCache
+from vminspect.executor import TaskExecutor
+from vminspect.filters import FileFilter
+from vminspect.manifest import Manifest
+from vminspect.store import ContentStore
+from vminspect.comparator import DiskComparator, MultiDiskComparator
 from vminspect.timeline import FSTimeline, NTFSTimeline
 from vminspect.winreg import RegistryHive, registry_root
 from vminspect.winreg import registries_path, user_registries_path
 
 __all__ = ['FileSystem',
+           'AppliancePool',
+           'Manifest',
+           'ManifestCache',
+           'FileFilter',
+           'ContentStore',
            'RegistryHive',
            'registry_root',
            'registries_path',
            'user_registries_path',
            'usn_journal',
            'DiskComparator',
+           'TaskExecutor',
+           'MultiDiskComparator',
            'FSTimeline',
            'NTFSTimeline',
            'VulnScanner',
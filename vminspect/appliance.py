@@ -0,0 +1,274 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Pool of pre-launched GuestFS appliances."""
+
+
+import time
+import logging
+from itertools import count
+from threading import Lock, Thread
+
+from guestfs import GuestFS
+
+from vminspect.filesystem import launch_appliance
+
+
+class AppliancePool:
+    """Keeps a set of launched GuestFS appliances ready to be used.
+
+    Launching a libguestfs appliance boots a small VM which takes
+    several seconds. The pool launches the appliances beforehand
+    and hot-adds the disk drives to them when acquired.
+    Once released, the drives are hot-removed and the appliance
+    is ready to be reused.
+
+    Drive hot-plugging is supported only by the libvirt backend.
+    On other backends, the pool launches no appliance beforehand
+    and falls back to launching a new one on every acquisition
+    and closing it on release.
+
+    size controls the maximum amount of idle appliances kept in the pool.
+    Appliances idle for longer than idle_timeout seconds are closed.
+    The pool is refilled in background up to its size whenever appliances
+    are released or closed. If no appliance is idle, a new one
+    is launched on acquisition and recycled on release as well.
+    If healthcheck is True, appliances are pinged before being handed out.
+
+    """
+    def __init__(self, size=2, idle_timeout=300, healthcheck=True):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.healthcheck = healthcheck
+        self._lock = Lock()
+        self._idle = []
+        self._drives = {}
+        self._hotplug = None
+        self._closed = False
+        self._refilling = False
+        self._labels = count()
+        self.logger = logging.getLogger(
+            "%s.%s" % (self.__module__, self.__class__.__name__))
+
+    def __enter__(self):
+        self.start()
+
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def start(self):
+        """Launches appliances until the pool is full."""
+        self._closed = False
+        self._fill()
+
+    def acquire(self, *disks):
+        """Returns a launched GuestFS handle with the given disks attached.
+
+        The disks are attached in read only mode.
+
+        """
+        self._evict()
+
+        if not self._hotplug_supported():
+            return launch_appliance(*disks)
+
+        handler = self._idle_handler() or self._launch()
+
+        try:
+            self._hotplug_drives(handler, disks)
+        except RuntimeError as error:
+            self.logger.debug("Unable to hot-add drives: %s", error)
+
+            self.release(handler)
+            raise
+
+        return handler
+
+    def release(self, handler):
+        """Returns the given GuestFS handle to the pool.
+
+        The handle is closed if the pool is full or its drives
+        cannot be removed.
+
+        """
+        if self._recycle(handler):
+            with self._lock:
+                self._idle.append((time.monotonic(), handler))
+        else:
+            self._close(handler)
+
+        self._evict()
+
+    def close(self):
+        """Closes all the idle appliances."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        for _, handler in idle:
+            self._close(handler)
+
+    def _idle_handler(self):
+        """Pops a healthy appliance from the pool, None if none available."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+
+                _, handler = self._idle.pop()
+
+            if not self.healthcheck or self._healthy(handler):
+                return handler
+
+            self._close(handler)
+
+    def _hotplug_drives(self, handler, disks):
+        labels = []
+
+        try:
+            for disk in disks:
+                label = 'pool%d' % next(self._labels)
+                handler.add_drive_opts(disk, readonly=True, label=label)
+                labels.append(label)
+        finally:
+            self._drives[handler] = labels
+
+    def _recycle(self, handler):
+        """Detaches the drives from the handle, returns True on success."""
+        labels = self._drives.pop(handler, None)
+
+        if labels is None or self._closed or len(self._idle) >= self.size:
+            return False
+
+        try:
+            handler.umount_all()
+            for label in labels:
+                handler.remove_drive(label)
+        except RuntimeError as error:
+            self.logger.debug("Unable to hot-remove drives: %s", error)
+
+            return False
+
+        return True
+
+    def _evict(self):
+        """Closes the appliances idle for longer than the timeout."""
+        deadline = time.monotonic() - self.idle_timeout
+
+        with self._lock:
+            expired = [h for t, h in self._idle if t < deadline]
+            self._idle = [(t, h) for t, h in self._idle if t >= deadline]
+
+        for handler in expired:
+            self._close(handler)
+
+        self._refill()
+
+    def _refill(self):
+        """Launches the missing appliances in background."""
+        if not self._hotplug_supported():
+            return
+
+        with self._lock:
+            if (self._refilling or self._closed or
+                    len(self._idle) >= self.size):
+                return
+
+            self._refilling = True
+
+        thread = Thread(target=self._refill_pool, daemon=True)
+        thread.start()
+
+    def _fill(self):
+        """Launches appliances until the pool is full or closed."""
+        while self._hotplug_supported() and not self._closed:
+            with self._lock:
+                if len(self._idle) >= self.size:
+                    return
+
+            handler = self._launch()
+
+            with self._lock:
+                if not self._closed:
+                    self._idle.append((time.monotonic(), handler))
+                    continue
+
+            self._close(handler)
+
+    def _refill_pool(self):
+        try:
+            self._fill()
+        except RuntimeError as error:
+            self.logger.debug("Unable to launch appliance: %s", error)
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def _hotplug_supported(self):
+        """Returns whether the GuestFS backend supports drive hot-plugging."""
+        if self._hotplug is None:
+            handler = GuestFS()
+
+            try:
+                self._hotplug = handler.get_backend().startswith('libvirt')
+            finally:
+                handler.close()
+
+            self.logger.debug("Drive hot-plugging supported: %s.",
+                              self._hotplug)
+
+        return self._hotplug
+
+    @staticmethod
+    def _launch():
+        handler = GuestFS()
+        handler.launch()
+
+        return handler
+
+    @staticmethod
+    def _healthy(handler):
+        try:
+            handler.echo_daemon(['ping'])
+        except RuntimeError:
+            return False
+
+        return True
+
+    def _close(self, handler):
+        self._drives.pop(handler, None)
+
+        try:
+            handler.close()
+        except RuntimeError as error:
+            self.logger.debug("Error closing appliance: %s", error)
+
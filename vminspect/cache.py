@@ -0,0 +1,138 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""On disk cache of File System hash manifests."""
+
+
+import os
+import json
+import hashlib
+import logging
+from tempfile import NamedTemporaryFile
+
+from vminspect.manifest import Manifest
+from vminspect.image import image_identity
+
+
+class ManifestCache:
+    """Stores the hashes of the files contained within disk images.
+
+    The manifests are keyed by the identity of the disk image:
+    its path, size and modification time. For QCOW2 images the identity
+    of the whole backing chain is included as well.
+
+    path is the directory where the manifests are stored.
+    max_size is the maximum amount of bytes occupied by the manifests,
+    the least recently used ones are evicted when exceeding it.
+
+    """
+    def __init__(self, path, max_size=1024**3):
+        self.path = path
+        self.max_size = max_size
+        self.logger = logging.getLogger(
+            "%s.%s" % (self.__module__, self.__class__.__name__))
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def load(self, disk, hashtype='sha1', file_filter=None):
+        """Returns the cached Manifest of the given disk, None if missing.
+
+            {'/path/on/filesystem': 'file_hash'}
+
+        The Manifest is memory mapped from the cache file.
+
+        Manifests of filtered disks are keyed by the FileFilter rules as well.
+
+        """
+        path = self._manifest_path(disk, hashtype, file_filter)
+
+        try:
+            files = Manifest.load(path)
+        except (OSError, ValueError):
+            return None
+
+        os.utime(path)  # mark as recently used
+        self.logger.debug("Manifest of %s loaded from cache.", disk)
+
+        return files
+
+    def store(self, disk, files, hashtype='sha1', file_filter=None):
+        """Stores the manifest of the given disk."""
+        path = self._manifest_path(disk, hashtype, file_filter)
+
+        if not isinstance(files, Manifest):
+            files = Manifest.from_items(files.items())
+
+        with NamedTemporaryFile(dir=self.path, delete=False) as tempfile:
+            pass
+
+        try:
+            files.save(tempfile.name)
+        except BaseException:
+            os.remove(tempfile.name)
+            raise
+
+        os.replace(tempfile.name, path)
+
+        self._evict()
+
+    def _manifest_path(self, disk, hashtype, file_filter=None):
+        identity = (hashtype, image_identity(disk))
+        if file_filter is not None:
+            identity += (file_filter.key, )
+
+        identity = json.dumps(identity)
+        key = hashlib.sha1(identity.encode('utf8')).hexdigest()
+
+        return os.path.join(self.path, key + MANIFEST_EXTENSION)
+
+    def _evict(self):
+        """Removes the least recently used manifests exceeding the size."""
+        manifests = []
+
+        for name in os.listdir(self.path):
+            if name.endswith(MANIFEST_EXTENSION):
+                path = os.path.join(self.path, name)
+                stat = os.stat(path)
+                manifests.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(m[1] for m in manifests)
+
+        for _, size, path in sorted(manifests):
+            if total <= self.max_size:
+                break
+
+            self.logger.debug("Evicting manifest %s.", path)
+            os.remove(path)
+            total -= size
+
+
+MANIFEST_EXTENSION = '.manifest'
@@ -31,40 +31,85 @@
 """Module for comparing Virtual Machine Disk Images."""
 
 
+import os
+import random
+import stat
+import shutil
 import logging
-from itertools import chain
-from pebble import concurrent
+import marshal
+import ntpath
+import tarfile
+import posixpath
+from itertools import chain, islice
+from collections import defaultdict, deque
 from pathlib import Path, PurePath
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory, mkstemp
 
 from vminspect.winreg import RegistryHive, registry_root
-from vminspect.filesystem import FileSystem, hash_filesystem
+from vminspect.image import overlay_extents
+from vminspect.executor import task_executor
+from vminspect.manifest import Manifest
+from vminspect.filesystem import FileSystem, FileSystemGroup
+from vminspect.filesystem import posix_path, relative_path
+from vminspect.filesystem import hash_filesystem, hash_nodes, stat_filesystem
+from vminspect.filesystem import stat_nodes, read_run
+from vminspect.filesystem import sorted_checksums, is_partial
 from vminspect.winreg import user_registries_path, registries_path
 
 
 class DiskComparator:
-    """Performs an in depth comparison of two given disk images."""
-    def __init__(self, disk0, disk1):
+    """Performs an in depth comparison of two given disk images.
+
+    If an appliance pool is given, the disks are mounted
+    on appliances borrowed from it.
+
+    If shared is True, both disks are attached to a single appliance
+    halving its start up time and memory footprint.
+
+    If a ManifestCache is given, the disks hashes are loaded from it
+    when available.
+
+    If a TaskExecutor is given, the concurrent comparisons
+    and extractions are run on it.
+
+    """
+    def __init__(self, disk0, disk1, pool=None, shared=False, cache=None,
+                 executor=None):
         self.disks = (disk0, disk1)
+        self.pool = pool
+        self.shared = shared
+        self.cache = cache
+        self.executor = executor
         self.filesystems = ()
+        self._group = None
         self._comparison = {}
         self.logger = logging.getLogger(
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self.filesystems = (FileSystem(self.disks[0]),
-                            FileSystem(self.disks[1]))
+        if self.shared:
+            self._group = FileSystemGroup(self.disks, pool=self.pool)
+            self._group.mount()
+            self.filesystems = self._group.filesystems
+        else:
+            self.filesystems = (FileSystem(self.disks[0], pool=self.pool),
+                                FileSystem(self.disks[1], pool=self.pool))
 
-        for filesystem in self.filesystems:
-            filesystem.mount()
+            for filesystem in self.filesystems:
+                filesystem.mount()
 
         return self
 
     def __exit__(self, *_):
-        for filesystem in self.filesystems:
-            filesystem.umount()
+        if self._group is not None:
+            self._group.umount()
+        else:
+            for filesystem in self.filesystems:
+                filesystem.umount()
 
-    def compare(self, concurrent=False, identify=False, size=False):
+    def compare(self, concurrent=False, identify=False, size=False, shards=1,
+                overlay=False, quick=False, merge=False, memory_limit=None,
+                file_filter=None, sample_threshold=None):
         """Compares the two disks according to flags.
 
         Generates the following report:
@@ -80,15 +125,57 @@ class DiskComparator:
                                  'original_sha1': 'sha1_of_the_file_on_disk0'}]}
 
         If concurrent is set to True, the logic will use multiple CPUs to
-        speed up the process.
+        speed up the process running on the comparator TaskExecutor.
 
         The identify and size keywords will add respectively the type
         and the size of the files to the results.
 
+        If shards is greater than one, each disk content is split in shards
+        hashed concurrently by separate appliances.
+
+        If overlay is True, the second disk must be a QCOW2 overlay
+        of the first one. Only the File Systems written within the overlay
+        are visited and only their files which metadata differ are hashed.
+
+        If quick is True, only the files which metadata differs are hashed.
+        By default, all the files are hashed for a strict verification.
+
+        If merge is True, the disks hashes are sorted by path on temporary
+        files and merge joined rather than loaded in dictionaries,
+        bounding the memory consumption.
+
+        If memory_limit is given, the path sorted hashes exceeding it
+        in bytes are spilled on temporary files.
+
+        If a FileFilter is given, only the selected files are compared.
+        The filter is applied on the files metadata, the content
+        of the other files is never read.
+
+        If sample_threshold is given, the files larger than it in bytes
+        are compared through partial checksums sampling their content.
+        Files with matching partial checksums but different metadata
+        are fully hashed, as well as the reported ones: the report
+        contains SHA1 hashes only, None for the unreadable files.
+
         """
         self.logger.debug("Comparing FS contents.")
-        results = compare_filesystems(self.filesystems[0], self.filesystems[1],
-                                      concurrent=concurrent)
+        if overlay:
+            results = compare_overlay(self.filesystems[0], self.filesystems[1],
+                                      concurrent=concurrent,
+                                      file_filter=file_filter,
+                                      executor=self.executor)
+        elif quick:
+            results = quick_compare_filesystems(
+                self.filesystems[0], self.filesystems[1],
+                concurrent=concurrent, file_filter=file_filter,
+                executor=self.executor)
+        else:
+            results = compare_filesystems(
+                self.filesystems[0], self.filesystems[1],
+                concurrent=concurrent, shards=shards, cache=self.cache,
+                merge=merge, memory_limit=memory_limit,
+                file_filter=file_filter, sample_threshold=sample_threshold,
+                executor=self.executor)
 
         if identify:
             self.logger.debug("Gatering file types.")
@@ -102,7 +189,7 @@ class DiskComparator:
 
         return results
 
-    def extract(self, disk, files, path='.'):
+    def extract(self, disk, files, path='.', workers=1, store=None):
         """Extracts the given files from the given disk.
 
         Disk must be an integer (1 or 2) indicating from which of the two disks
@@ -113,6 +200,12 @@ class DiskComparator:
 
         Files will be extracted in path and will be named with their sha1.
 
+        If workers is greater than one, the files are extracted
+        by as many processes, or by the comparator TaskExecutor if given.
+
+        If a ContentStore is given, the files are added to it
+        instead of being extracted in path.
+
         Returns a dictionary.
 
             {'extracted_files': [<sha1>, <sha1>],
@@ -120,12 +213,14 @@ class DiskComparator:
 
         """
         self.logger.debug("Extracting files.")
-        extracted_files, failed = self._extract_files(disk, files, path)
+        extracted_files, failed = self._extract_files(disk, files, path,
+                                                      workers, store)
 
         return {'extracted_files': [f for f in extracted_files.keys()],
                 'extraction_errors': [f for f in failed.keys()]}
 
-    def compare_registry(self, concurrent=False):
+    def compare_registry(self, concurrent=False, merkle=False, fast=False,
+                         sample=None):
         """Compares the Windows Registry contained within the two File Systems.
 
         It parses all the registry hive files contained within the disks
@@ -141,8 +236,16 @@ class DiskComparator:
         If the second disk contains a new registry hive,
         its content can be listed using winreg.RegistryHive.registry() method.
 
-        If the concurrent flag is True,
-        two processes will be used speeding up the comparison on multiple CPUs.
+        If the concurrent flag is True, the hives are parsed
+        on the comparator TaskExecutor speeding up the comparison
+        on multiple CPUs.
+
+        If merkle is True, only the hives subtrees which digests differ
+        are visited.
+
+        If fast is True, the values of the keys with the same
+        last modification timestamp and amount of values are not compared
+        but for a random sample of them (see compare_hive_files).
 
         """
         self.logger.debug("Comparing Windows registries.")
@@ -150,14 +253,20 @@ class DiskComparator:
         self._assert_windows()
 
         return compare_registries(self.filesystems[0], self.filesystems[1],
-                                  concurrent=concurrent)
+                                  concurrent=concurrent,
+                                  executor=self.executor, merkle=merkle,
+                                  fast=fast, sample=sample)
 
-    def _extract_files(self, disk, files, path):
-        path = str(PurePath(path, 'extracted_files'))
-
-        makedirs(path)
+    def _extract_files(self, disk, files, path, workers, store):
+        if store is not None:
+            path = store.path
+        else:
+            path = str(PurePath(path, 'extracted_files'))
+            makedirs(path)
 
-        extracted, failed = extract_files(self.filesystems[disk], files, path)
+        extracted, failed = extract_files(self.filesystems[disk], files, path,
+                                          workers=workers, store=store,
+                                          executor=self.executor)
 
         self.logger.info("Files extracted into %s.", path)
         if failed:
@@ -172,14 +281,196 @@ class DiskComparator:
             raise RuntimeError("Both disks must contain a Windows File System")
 
 
-def compare_filesystems(fs0, fs1, concurrent=False):
+class MultiDiskComparator:
+    """Compares a baseline disk image against multiple target ones.
+
+    The baseline is mounted and hashed once while the targets
+    are compared against it concurrently by at most workers threads,
+    or on the given TaskExecutor.
+
+    If an appliance pool is given, the disks are mounted
+    on appliances borrowed from it.
+
+    If a ManifestCache is given, the disks hashes are loaded from it
+    when available.
+
+    """
+    def __init__(self, baseline, targets, workers=2, pool=None, cache=None,
+                 executor=None):
+        self.baseline = baseline
+        self.targets = tuple(targets)
+        self.workers = workers
+        self.pool = pool
+        self.cache = cache
+        self.executor = executor
+        self.filesystem = None
+        self.logger = logging.getLogger(
+            "%s.%s" % (self.__module__, self.__class__.__name__))
+
+    def __enter__(self):
+        self.filesystem = FileSystem(self.baseline, pool=self.pool)
+        self.filesystem.mount()
+
+        return self
+
+    def __exit__(self, *_):
+        self.filesystem.umount()
+
+    def compare(self, identify=False, size=False, shards=1):
+        """Compares each target disk against the baseline one.
+
+        Generates the following report:
+
+        ::
+
+            {'reports': {'/path/to/target/disk': <DiskComparator report>},
+             'aggregate': {'created_files': {'/path': ['/target/disk']},
+                           'deleted_files': {'/path': ['/target/disk']},
+                           'modified_files': {'/path': ['/target/disk']}}}
+
+        The aggregate lists, for each changed file,
+        the target disks in which it was changed.
+
+        The identify and size keywords will add respectively the type
+        and the size of the files to the reports.
+
+        If shards is greater than one, each disk content is split in shards
+        hashed concurrently by separate appliances.
+
+        """
+        self.logger.debug("Hashing baseline disk %s.", self.baseline)
+        files = hash_filesystem(self.filesystem, shards=shards,
+                                cache=self.cache)
+
+        with task_executor(self.executor, workers=self.workers) as tasks:
+            futures = [tasks.submit_io(self._compare_target, target, files,
+                                       identify, size, shards)
+                       for target in self.targets]
+
+            reports = {target: tasks.result(future)
+                       for target, future in zip(self.targets, futures)}
+
+        return {'reports': reports, 'aggregate': aggregate_reports(reports)}
+
+    def _compare_target(self, target, files, identify, size, shards):
+        self.logger.debug("Comparing target disk %s.", target)
+
+        filesystem = FileSystem(target, pool=self.pool)
+        filesystem.mount()
+
+        try:
+            results = file_comparison(
+                files, hash_filesystem(filesystem, shards=shards,
+                                       cache=self.cache))
+
+            if identify:
+                results = files_type(self.filesystem, filesystem, results)
+            if size:
+                results = files_size(self.filesystem, filesystem, results)
+        finally:
+            filesystem.umount()
+
+        return results
+
+
+def compare_chain(disks, pool=None, cache=None, shards=1, prefetch=1,
+                  executor=None):
+    """Compares each consecutive pair of a chain of disk images.
+
+    Each disk is mounted and hashed once, its hashes are reused
+    as the baseline of the following pair.
+
+    Up to prefetch following disks are hashed in the background
+    while the current pair is being compared,
+    on the given TaskExecutor if any.
+
+    Yields the (disk0, disk1, comparison) tuples as soon as ready,
+    the comparison being the same report as compare_filesystems.
+
+    """
+    disks = iter(disks)
+
+    with task_executor(executor, workers=prefetch + 1) as tasks:
+        pending = deque(
+            (disk, tasks.submit_io(hash_disk, disk, pool, cache, shards))
+            for disk in islice(disks, prefetch + 1))
+        previous = None
+
+        try:
+            while pending:
+                disk, future = pending.popleft()
+                files = tasks.result(future)
+
+                for following in islice(disks, 1):
+                    pending.append((following, tasks.submit_io(
+                        hash_disk, following, pool, cache, shards)))
+
+                if previous is not None:
+                    yield (previous[0], disk,
+                           file_comparison(previous[1], files))
+
+                previous = disk, files
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def aggregate_reports(reports):
+    """Groups the changed files of multiple comparison reports.
+
+    Returns a dictionary listing, for each file,
+    the keys of the reports in which it was changed.
+
+        {'created_files': {'/path': [<report key>, <report key>]},
+         'deleted_files': {'/path': [<report key>]},
+         'modified_files': {'/path': [<report key>]}}
+
+    """
+    aggregate = {kind: defaultdict(list) for kind
+                 in ('created_files', 'deleted_files', 'modified_files')}
+
+    for key, report in reports.items():
+        for kind, files in aggregate.items():
+            for file_meta in report[kind]:
+                files[file_meta['path']].append(key)
+
+    return {kind: dict(files) for kind, files in aggregate.items()}
+
+
+def compare_filesystems(fs0, fs1, concurrent=False, shards=1, cache=None,
+                        merge=False, memory_limit=None, file_filter=None,
+                        sample_threshold=None, executor=None):
     """Compares the two given filesystems.
 
     fs0 and fs1 are two mounted GuestFS instances
     containing the two disks to be compared.
 
-    If the concurrent flag is True,
-    two processes will be used speeding up the comparison on multiple CPUs.
+    If the concurrent flag is True, the File Systems are hashed concurrently
+    on the given TaskExecutor or on a default one.
+
+    If shards is greater than one, each File System content is split
+    in shards hashed concurrently by separate appliances.
+
+    If a ManifestCache is given, the hashes are loaded from it if present
+    and stored into it otherwise.
+
+    If merge is True, the hashes are sorted by path and compared
+    as a merge join instead of being loaded in dictionaries.
+    The hashes exceeding MERGE_MEMORY_LIMIT bytes are sorted
+    on temporary files.
+    The shards and cache options are not used in such case.
+
+    If memory_limit is given, the comparison is merged and the hashes
+    exceeding the limit in bytes are sorted on temporary files
+    keeping the memory consumption bounded.
+
+    If a FileFilter is given, only the selected files are hashed.
+
+    If sample_threshold is given, the files larger than it in bytes
+    are given partial checksums. The files which partial checksums match
+    but which metadata differ are fully hashed, as well as the created,
+    deleted and modified ones (see resolve_partial).
+    The shards and cache options are not used in such case.
 
     Returns a dictionary containing files created, removed and modified.
 
@@ -188,19 +479,312 @@ def compare_filesystems(fs0, fs1, concurrent=False):
          'modified_files': [<files in both fs0 and fs1 but different>]}
 
     """
+    if merge or memory_limit is not None:
+        return merge_compare_filesystems(fs0, fs1, concurrent=concurrent,
+                                         memory_limit=memory_limit,
+                                         file_filter=file_filter,
+                                         executor=executor)
+
     if concurrent:
-        future0 = concurrent_hash_filesystem(fs0)
-        future1 = concurrent_hash_filesystem(fs1)
+        with task_executor(executor) as tasks:
+            future0, future1 = (
+                tasks.submit_io(hash_filesystem, fs, shards=shards,
+                                cache=cache, file_filter=file_filter,
+                                sample_threshold=sample_threshold)
+                for fs in (fs0, fs1))
+
+            files0 = tasks.result(future0)
+            files1 = tasks.result(future1)
+    else:
+        files0 = hash_filesystem(fs0, shards=shards, cache=cache,
+                                 file_filter=file_filter,
+                                 sample_threshold=sample_threshold)
+        files1 = hash_filesystem(fs1, shards=shards, cache=cache,
+                                 file_filter=file_filter,
+                                 sample_threshold=sample_threshold)
+
+    if sample_threshold is not None:
+        escalate_partial(fs0, fs1, files0, files1)
 
-        files0 = future0.result()
-        files1 = future1.result()
+        return resolve_partial(fs0, fs1, file_comparison(files0, files1))
+
+    return file_comparison(files0, files1)
+
+
+def escalate_partial(fs0, fs1, files0, files1):
+    """Fully hashes the files which partial checksums match
+    but which metadata differ on the two File Systems.
+
+    The files dictionaries are updated with the full checksums.
+
+    """
+    partial = [path for path, checksum in files1.items()
+               if is_partial(checksum) and files0.get(path) == checksum]
+    nodes0 = dict(fs0.stats(partial))
+    nodes1 = dict(fs1.stats(partial))
+
+    for path in (p for p in partial if p in nodes0 and p in nodes1):
+        if not same_metadata(nodes0[path], nodes1[path]):
+            try:
+                files0[path] = fs0.checksum(path)
+                files1[path] = fs1.checksum(path)
+            except RuntimeError:
+                logging.debug("Unable to hash %s.", path)
+
+
+def resolve_partial(fs0, fs1, comparison):
+    """Fully hashes the reported files which still carry
+    a partial checksum so that only SHA1 hashes are reported.
+
+    The hash of the files which cannot be read is set to None.
+
+    """
+    for kind, entries in comparison.items():
+        for entry in entries:
+            for key, filesystem in (('original_sha1', fs0), ('sha1', fs1)):
+                if key in entry and is_partial(entry[key]):
+                    try:
+                        entry[key] = filesystem.checksum(entry['path'])
+                    except RuntimeError:
+                        logging.debug("Unable to hash %s.", entry['path'])
+                        entry[key] = None
+
+    return comparison
+
+
+def merge_compare_filesystems(fs0, fs1, concurrent=False, memory_limit=None,
+                              file_filter=None, executor=None):
+    """Compares the two given filesystems merging their path sorted hashes.
+
+    If the concurrent flag is True, the File Systems are hashed concurrently
+    on the given TaskExecutor or on a default one.
+
+    The hashes of each File System exceeding memory_limit bytes,
+    MERGE_MEMORY_LIMIT if None, are sorted on temporary files
+    and merged from there.
+
+    If a FileFilter is given, only the selected files are hashed.
+
+    Returns a dictionary containing files created, removed and modified.
+
+    """
+    if memory_limit is None:
+        memory_limit = MERGE_MEMORY_LIMIT
+
+    if concurrent:
+        with task_executor(executor) as tasks:
+            future0, future1 = (
+                tasks.submit_io(sorted_checksums, fs,
+                                memory_limit=memory_limit,
+                                file_filter=file_filter)
+                for fs in (fs0, fs1))
+
+            files0 = tasks.result(future0)
+            files1 = tasks.result(future1)
+    else:
+        files0 = sorted_checksums(fs0, memory_limit=memory_limit,
+                                  file_filter=file_filter)
+        files1 = sorted_checksums(fs1, memory_limit=memory_limit,
+                                  file_filter=file_filter)
+
+    return comparison_report(merge_file_comparison(files0, files1))
+
+
+def quick_compare_filesystems(fs0, fs1, concurrent=False, file_filter=None,
+                              executor=None):
+    """Compares the two given filesystems relying on the files metadata.
+
+    Files with the same size, modification time, change time and inode
+    on both File Systems are considered unchanged and are not hashed.
+    Files lacking timestamps are always hashed.
+
+    If a FileFilter is given, only the selected files are compared.
+
+    If the concurrent flag is True, the File Systems are processed
+    concurrently on the given TaskExecutor or on a default one.
+
+    Returns a dictionary containing files created, removed and modified.
+
+        {'created_files': [<files in fs1 and not in fs0>],
+         'deleted_files': [<files in fs0 and not in fs1>],
+         'modified_files': [<files in both fs0 and fs1 but different>]}
+
+    """
+    if concurrent:
+        with task_executor(executor) as tasks:
+            future0 = tasks.submit_io(stat_filesystem, fs0)
+            future1 = tasks.submit_io(stat_filesystem, fs1)
+
+            nodes0 = tasks.result(future0)
+            nodes1 = tasks.result(future1)
+    else:
+        nodes0 = stat_filesystem(fs0)
+        nodes1 = stat_filesystem(fs1)
+
+    return metadata_comparison(fs0, fs1, nodes0, nodes1,
+                               concurrent=concurrent, file_filter=file_filter,
+                               executor=executor)
+
+
+def metadata_comparison(fs0, fs1, nodes0, nodes1, concurrent=False,
+                        file_filter=None, executor=None):
+    """Compares the two {path: NodeStat} dictionaries of the File Systems
+    hashing only the files which metadata differ, the created
+    and the deleted ones.
+
+    If a FileFilter is given, only the selected files are compared.
+
+    """
+    if file_filter is not None:
+        nodes0 = filter_stats(fs0, nodes0, file_filter)
+        nodes1 = filter_stats(fs1, nodes1, file_filter)
+
+    changed = [(path, False) for path, node in nodes1.items()
+               if path in nodes0 and not same_metadata(nodes0[path], node)]
+    deleted = [(path, False) for path in nodes0 if path not in nodes1]
+    created = [(path, False) for path in nodes1 if path not in nodes0]
+
+    if concurrent:
+        with task_executor(executor) as tasks:
+            future0 = tasks.submit_io(hash_nodes, fs0, changed + deleted)
+            future1 = tasks.submit_io(hash_nodes, fs1, changed + created)
+
+            files0 = tasks.result(future0)
+            files1 = tasks.result(future1)
     else:
-        files0 = hash_filesystem(fs0)
-        files1 = hash_filesystem(fs1)
+        files0 = hash_nodes(fs0, changed + deleted)
+        files1 = hash_nodes(fs1, changed + created)
 
     return file_comparison(files0, files1)
 
 
+def filter_stats(filesystem, nodes, file_filter):
+    """Applies the FileFilter to the {path: NodeStat} dictionary."""
+    ignorecase = filesystem.osname == 'windows'
+
+    return {path: node for path, node in nodes.items()
+            if file_filter.match(path, node.size, ignorecase)}
+
+
+def same_metadata(node0, node1):
+    """Returns whether the two NodeStat describe the same file content."""
+    return (node0.mtime > 0 and
+            (node0.size, node0.mtime, node0.ctime, node0.inode) ==
+            (node1.size, node1.mtime, node1.ctime, node1.inode))
+
+
+def compare_overlay(fs0, fs1, concurrent=False, file_filter=None,
+                    executor=None):
+    """Compares the two given filesystems
+    where the disk of fs1 is a QCOW2 overlay of the disk of fs0.
+
+    The allocation map of the overlay reveals which partitions
+    were written after the base image. The File Systems contained
+    in the untouched partitions are identical and are not visited.
+    Within the written ones, only the files which metadata differ
+    are hashed as quick_compare_filesystems does.
+
+    If a FileFilter is given, only the selected files are compared.
+
+    If the concurrent flag is True, the File Systems are processed
+    concurrently on the given TaskExecutor or on a default one.
+
+    Returns a dictionary containing files created, removed and modified.
+
+        {'created_files': [<files in fs1 and not in fs0>],
+         'deleted_files': [<files in fs0 and not in fs1>],
+         'modified_files': [<files in both fs0 and fs1 but different>]}
+
+    """
+    extents = overlay_extents(fs1.disk_path, fs0.disk_path)
+    clean = [mountpoint for mountpoint, device in fs1.inspection.mountpoints
+             if not device_written(fs1, device, extents)]
+
+    nodes0 = list(overlay_nodes(fs0, clean))
+    nodes1 = list(overlay_nodes(fs1, clean))
+
+    if concurrent:
+        with task_executor(executor) as tasks:
+            future0 = tasks.submit_io(stat_nodes, fs0, nodes0)
+            future1 = tasks.submit_io(stat_nodes, fs1, nodes1)
+
+            stats0 = tasks.result(future0)
+            stats1 = tasks.result(future1)
+    else:
+        stats0 = stat_nodes(fs0, nodes0)
+        stats1 = stat_nodes(fs1, nodes1)
+
+    return metadata_comparison(fs0, fs1, stats0, stats1,
+                               concurrent=concurrent, file_filter=file_filter,
+                               executor=executor)
+
+
+def device_written(filesystem, device, extents):
+    """Returns whether any of the given disk extents overlaps the device.
+
+    Devices which cannot be located within the disk (LVM, RAID...)
+    are considered written.
+
+    """
+    if device in filesystem.list_devices():
+        start, end = 0, filesystem.blockdev_getsize64(device)
+    else:
+        try:
+            disk = filesystem.part_to_dev(device)
+            number = filesystem.part_to_partnum(device)
+        except RuntimeError:
+            return True
+
+        start, end = next((p['part_start'], p['part_end'] + 1)
+                          for p in filesystem.part_list(disk)
+                          if p['part_num'] == number)
+
+    return any(s < end and e > start for s, e in extents)
+
+
+def overlay_nodes(filesystem, clean):
+    """Lists the nodes to be hashed excluding the clean mountpoints.
+
+    Yields (path, is_directory) tuples.
+
+    """
+    mountpoints = [mountpoint for mountpoint, _
+                   in filesystem.inspection.mountpoints]
+
+    for mountpoint in (m for m in mountpoints if m not in clean):
+        parents = [m for m in mountpoints if is_subpath(mountpoint, m)]
+
+        # mountpoints within written ones are walked with their parent
+        if not parents or max(parents, key=len) in clean:
+            yield from split_directory(filesystem, mountpoint, clean)
+
+
+def split_directory(filesystem, path, excluded):
+    """Splits the directory in nodes not containing the excluded paths.
+
+    Yields (path, is_directory) tuples.
+
+    """
+    if not any(is_subpath(e, path) for e in excluded):
+        yield path, True
+        return
+
+    for node_path, node in filesystem.directory_stats(path):
+        if posix_path(node_path) in excluded:
+            continue
+
+        if stat.S_ISDIR(node.mode):
+            yield from split_directory(filesystem, posix_path(node_path),
+                                       excluded)
+        elif stat.S_ISREG(node.mode):
+            yield node_path, False
+
+
+def is_subpath(path, directory):
+    """Returns whether the POSIX path is contained within the directory."""
+    return path != directory and path.startswith(directory.rstrip('/') + '/')
+
+
 def file_comparison(files0, files1):
     """Compares two dictionaries of files returning their difference.
 
@@ -208,7 +792,13 @@ def file_comparison(files0, files1):
          'deleted_files': [<files in files0 and not in files1>],
          'modified_files': [<files in both files0 and files1 but different>]}
 
+    If both are Manifests, their sorted entries are merge joined.
+
     """
+    if isinstance(files0, Manifest) and isinstance(files1, Manifest):
+        return comparison_report(
+            merge_file_comparison(files0.items(), files1.items()))
+
     comparison = {'created_files': [],
                   'deleted_files': [],
                   'modified_files': []}
@@ -231,7 +821,55 @@ def file_comparison(files0, files1):
     return comparison
 
 
-def extract_files(filesystem, files, path):
+def merge_file_comparison(files0, files1):
+    """Compares two path sorted iterables of (path, hash) tuples.
+
+    The iterables are consumed as a merge join in constant memory.
+
+    Yields the differences as they are found.
+
+        ('created_files', {'path': <path>, 'sha1': <hash>})
+        ('deleted_files', {'path': <path>, 'original_sha1': <hash>})
+        ('modified_files', {'path': <path>,
+                            'original_sha1': <hash>, 'sha1': <hash>})
+
+    """
+    files0 = iter(files0)
+    files1 = iter(files1)
+    entry0 = next(files0, None)
+    entry1 = next(files1, None)
+
+    while entry0 is not None or entry1 is not None:
+        if entry1 is None or (entry0 is not None and entry0[0] < entry1[0]):
+            yield 'deleted_files', {'path': entry0[0],
+                                    'original_sha1': entry0[1]}
+            entry0 = next(files0, None)
+        elif entry0 is None or entry1[0] < entry0[0]:
+            yield 'created_files', {'path': entry1[0], 'sha1': entry1[1]}
+            entry1 = next(files1, None)
+        else:
+            if entry0[1] != entry1[1]:
+                yield 'modified_files', {'path': entry1[0],
+                                         'original_sha1': entry0[1],
+                                         'sha1': entry1[1]}
+            entry0 = next(files0, None)
+            entry1 = next(files1, None)
+
+
+def comparison_report(differences):
+    """Collects the differences yielded by merge_file_comparison."""
+    comparison = {'created_files': [],
+                  'deleted_files': [],
+                  'modified_files': []}
+
+    for kind, entry in differences:
+        comparison[kind].append(entry)
+
+    return comparison
+
+
+def extract_files(filesystem, files, path, workers=1, store=None,
+                  executor=None):
     """Extracts requested files.
 
     files must be a list of files in the format
@@ -241,39 +879,175 @@ def extract_files(filesystem, files, path):
 
     files will be extracted into path which must exist beforehand.
 
+    The files are transferred grouped by directory as tar archives.
+    If workers is greater than one, the directories are split
+    across as many processes each one mounting the disk on its own appliance.
+    The processes are run by the given TaskExecutor if any.
+
+    If a ContentStore is given, the files are added to it instead of path.
+    Files already stored are not extracted again.
+
     Returns two dictionaries:
 
         {"sha1": "/local/path/sha1"} files successfully extracted
         {"sha1": "C:\\..\\text.txt"} files which could not be extracted windows
         {"sha1": "/../text.txt"} files which could not be extracted linux
 
+    Files without hash, as the unreadable ones, are reported as failed
+    keyed by their path.
+
     """
     extracted_files = {}
     failed_extractions = {}
+    directories = defaultdict(list)
 
     for file_to_extract in files:
-        source = file_to_extract['path']
-        destination = Path(path, file_to_extract['sha1'])
+        sha1 = file_to_extract['sha1']
 
-        if not destination.exists():
-            destination = str(destination)
+        if sha1 is None:
+            file_path = file_to_extract['path']
+            logging.warning("Unable to extract %s: no hash available.",
+                            file_path)
+            failed_extractions[file_path] = file_path
+            continue
 
-            try:
-                filesystem.download(source, destination)
-                extracted_files[file_to_extract['sha1']] = destination
-            except RuntimeError:
-                failed_extractions[file_to_extract['sha1']] = source
+        destination = Path(path, sha1)
+
+        if store is not None and store.reference(sha1):
+            extracted_files[sha1] = store.object_path(sha1)
+        elif store is None and destination.exists():
+            extracted_files[sha1] = str(destination)
         else:
-            extracted_files[file_to_extract['sha1']] = destination
+            directory = posixpath.dirname(posix_path(file_to_extract['path']))
+            directories[directory].append(file_to_extract)
+
+    if workers > 1:
+        shards = [list(directories.items())[i::workers]
+                  for i in range(workers)]
+
+        with task_executor(executor, backend='process',
+                           workers=workers) as tasks:
+            futures = [tasks.submit(extract_shard, filesystem.disk_path,
+                                    shard, path, store)
+                       for shard in shards if shard]
+
+            for future in futures:
+                extracted, failed = tasks.result(future)
+                extracted_files.update(extracted)
+                failed_extractions.update(failed)
+    else:
+        for directory, files_meta in directories.items():
+            extracted, failed = extract_directory(filesystem, directory,
+                                                  files_meta, path, store)
+            extracted_files.update(extracted)
+            failed_extractions.update(failed)
+
+    return extracted_files, failed_extractions
+
+
+def extract_shard(disk, directories, path, store):
+    """Mounts the disk and extracts the files of the given directories."""
+    extracted_files = {}
+    failed_extractions = {}
+
+    with FileSystem(disk) as filesystem:
+        for directory, files_meta in directories:
+            extracted, failed = extract_directory(filesystem, directory,
+                                                  files_meta, path, store)
+            extracted_files.update(extracted)
+            failed_extractions.update(failed)
+
+    return extracted_files, failed_extractions
+
+
+def extract_directory(filesystem, directory, files, path, store=None):
+    """Extracts the given files contained within the same directory
+    streaming them as a single tar archive.
+
+    The files missing from the archive are downloaded one by one.
+    The files which cannot be saved, as failing the ContentStore
+    hash verification, are reported as failed.
+
+    """
+    extracted_files = {}
+    failed_extractions = {}
+    names = {posixpath.basename(posix_path(f['path'])): f for f in files}
+
+    try:
+        with filesystem.archive(directory, names) as archive:
+            for member in (m for m in archive if m.isfile()):
+                file_meta = names.pop(relative_path(member.name), None)
+
+                if file_meta is None:
+                    continue
+
+                try:
+                    extracted_files[file_meta['sha1']] = save_file(
+                        archive.extractfile(member), file_meta['sha1'],
+                        path, store)
+                except RuntimeError as error:
+                    logging.debug("Unable to save %s: %s.",
+                                  file_meta['path'], error)
+                    failed_extractions[file_meta['sha1']] = file_meta['path']
+    except (RuntimeError, tarfile.TarError) as error:
+        logging.debug("Unable to archive %s: %s.", directory, error)
+
+    for file_meta in names.values():
+        try:
+            with NamedTemporaryFile() as tempfile:
+                filesystem.download(file_meta['path'], tempfile.name)
+
+                extracted_files[file_meta['sha1']] = save_file(
+                    tempfile, file_meta['sha1'], path, store)
+        except RuntimeError:
+            failed_extractions[file_meta['sha1']] = file_meta['path']
 
     return extracted_files, failed_extractions
 
 
-def compare_registries(fs0, fs1, concurrent=False):
+def save_file(fileobj, sha1, path, store=None):
+    """Saves the file content into path named by its sha1
+    or into the ContentStore if given.
+
+    Returns the path of the saved file.
+
+    """
+    if store is not None:
+        return store.add(sha1, fileobj)
+
+    destination = str(Path(path, sha1))
+
+    with open(destination, 'wb') as destination_file:
+        shutil.copyfileobj(fileobj, destination_file)
+
+    return destination
+
+
+def compare_registries(fs0, fs1, concurrent=False, executor=None,
+                       merkle=False, fast=False, sample=None):
     """Compares the Windows Registry contained within the two File Systems.
 
-    If the concurrent flag is True,
-    two processes will be used speeding up the comparison on multiple CPUs.
+    The hives are compared one pair at a time. The differences of the keys
+    sharing the same path in multiple hives, as the HKCU ones of different
+    users, are merged together (see update_comparison).
+
+    If the concurrent flag is True, each hive is downloaded and parsed
+    on its own on the given TaskExecutor, or on a default one,
+    speeding up the comparison on multiple CPUs. Each task is waited
+    for REGISTRY_TIMEOUT seconds at most unless the TaskExecutor
+    has its own timeout.
+    Each hive is parsed as soon as downloaded and compared
+    with its counterpart as soon as both are parsed.
+    The parsed keys are exchanged with the workers through sorted
+    record files merged in place (see dump_registry_files).
+
+    If merkle is True, each pair of hives is compared descending
+    only into the subtrees which Merkle digests differ
+    (see compare_hive_files).
+
+    If fast is True, the values of the keys with the same timestamp
+    and amount of values are assumed unchanged. A sample fraction
+    of such keys, REGISTRY_SAMPLE if None, is fully compared anyway.
 
     Returns a dictionary.
 
@@ -287,16 +1061,228 @@ def compare_registries(fs0, fs1, concurrent=False):
     hives = compare_hives(fs0, fs1)
 
     if concurrent:
-        future0 = concurrent_parse_registries(fs0, hives)
-        future1 = concurrent_parse_registries(fs1, hives)
-
-        registry0 = future0.result()
-        registry1 = future1.result()
+        with task_executor(executor, timeout=REGISTRY_TIMEOUT) as tasks:
+            return concurrent_compare_hives(fs0, fs1, hives, tasks,
+                                            merkle=merkle, fast=fast,
+                                            sample=sample)
     else:
-        registry0 = parse_registries(fs0, hives)
-        registry1 = parse_registries(fs1, hives)
+        return sequential_compare_hives(fs0, fs1, hives, merkle=merkle,
+                                        fast=fast, sample=sample)
+
+
+def concurrent_compare_hives(fs0, fs1, hives, tasks, merkle=False,
+                             fast=False, sample=None):
+    """Compares the given registry hives fanning them out
+    on the TaskExecutor one per hive and File System.
+
+    The downloads run on the I/O threads while the already
+    downloaded hives are parsed by the workers.
+
+    If merkle or fast are True, each pair of hives is compared
+    by a single worker through compare_hive_files.
+
+    The tasks are waited for the TaskExecutor timeout,
+    REGISTRY_TIMEOUT if not set.
+
+    """
+    timeout = REGISTRY_TIMEOUT if tasks.timeout is None else tasks.timeout
+    comparison = {'created_keys': {},
+                  'deleted_keys': [],
+                  'created_values': {},
+                  'deleted_values': {},
+                  'modified_values': {}}
+
+    with TemporaryDirectory() as path:
+        downloads = [[tasks.submit_io(download_registry, fs, hive, path)
+                      for fs in (fs0, fs1)]
+                     for hive in hives]
+
+        if merkle or fast:
+            comparisons = [tasks.submit(compare_hive_files,
+                                        tasks.result(future0, timeout),
+                                        tasks.result(future1, timeout), hive,
+                                        merkle=merkle, fast=fast,
+                                        sample=sample)
+                           for hive, (future0, future1)
+                           in zip(hives, downloads)]
+
+            for future in comparisons:
+                update_comparison(comparison, tasks.result(future, timeout))
+
+            return comparison
+
+        parsings = [[tasks.submit(dump_registry_files,
+                                  ((tasks.result(future, timeout), hive), ),
+                                  path)
+                     for future in futures]
+                    for hive, futures in zip(hives, downloads)]
+
+        for future0, future1 in parsings:
+            update_comparison(comparison, compare_hive_records(
+                tasks.result(future0, timeout),
+                tasks.result(future1, timeout)))
+
+    return comparison
+
+
+def sequential_compare_hives(fs0, fs1, hives, merkle=False, fast=False,
+                             sample=None):
+    """Compares the given registry hives one pair at a time.
+
+    If merkle or fast are True, each pair of hives is compared
+    through compare_hive_files, otherwise through their record files
+    as concurrent_compare_hives does.
+
+    """
+    comparison = {'created_keys': {},
+                  'deleted_keys': [],
+                  'created_values': {},
+                  'deleted_values': {},
+                  'modified_values': {}}
+
+    with TemporaryDirectory() as path:
+        for hive in hives:
+            path0 = download_registry(fs0, hive, path)
+            path1 = download_registry(fs1, hive, path)
+
+            if merkle or fast:
+                hive_comparison = compare_hive_files(
+                    path0, path1, hive, merkle=merkle, fast=fast,
+                    sample=sample)
+            else:
+                hive_comparison = compare_hive_records(
+                    dump_registry_files(((path0, hive), ), path),
+                    dump_registry_files(((path1, hive), ), path))
+
+            update_comparison(comparison, hive_comparison)
+
+            os.remove(path0)
+            os.remove(path1)
+
+    return comparison
+
+
+def compare_hive_records(path0, path1):
+    """Compares the two record files written by dump_registry_files."""
+    with open(path0, 'rb') as records0:
+        with open(path1, 'rb') as records1:
+            return merge_registry_comparison(read_run(records0),
+                                             read_run(records1))
+
+
+def compare_hive_files(path0, path1, hive, merkle=True, fast=False,
+                       sample=None):
+    """Compares two local copies of the given registry hive.
+
+    Both hives are walked in parallel by key name.
+
+    If merkle is True, the walk descends only into the subtrees
+    which Merkle digests differ: the values of the unchanged keys
+    are never parsed.
+
+    If fast is True, the values of the keys with the same last
+    modification timestamp and amount of values are not parsed
+    but for the given sample fraction of them, REGISTRY_SAMPLE if None.
+    Windows updates the timestamp whenever a key value is written,
+    the sample gives a measure of how much the assumption holds.
+
+    Returns the same dictionary of registry_comparison.
+
+    """
+    comparison = {'created_keys': {},
+                  'deleted_keys': [],
+                  'created_values': {},
+                  'deleted_values': {},
+                  'modified_values': {}}
+    hive0 = RegistryHive(path0)
+    hive1 = RegistryHive(path1)
+    hive0.rootkey = hive1.rootkey = registry_root(hive)
+    sample = REGISTRY_SAMPLE if sample is None else sample
+    if merkle:
+        digests0 = hive0.node_digests()
+        digests1 = hive1.node_digests()
+    # the root key is not reported by RegistryHive.keys, neither its values
+    nodes = [(hive0.root(), hive1.root(), hive1.rootkey, False)]
+
+    while nodes:
+        node0, node1, key, compare = nodes.pop()
+
+        if merkle and digests0[node0][0] == digests1[node1][0]:
+            continue
+
+        if merkle:
+            compare = compare and digests0[node0][1] != digests1[node1][1]
+        if fast and compare:
+            pruned = same_key_metadata(hive0, node0, hive1, node1)
+            compare = not pruned or random.random() < sample
+        else:
+            pruned = False
+
+        if compare:
+            timestamp = hive1.key_timestamp(node1)
+            created, deleted, modified = compare_values(
+                hive0.key_values(node0), hive1.key_values(node1))
+
+            if pruned and (created or deleted or modified):
+                logging.warning("Sampled key %s changed with no timestamp "
+                                "nor values count change.", key)
+
+            if created:
+                comparison['created_values'][key] = (timestamp, created)
+            if deleted:
+                comparison['deleted_values'][key] = (timestamp, deleted)
+            if modified:
+                comparison['modified_values'][key] = (timestamp, modified)
+
+        children0 = {hive0.node_name(c): c for c in hive0.node_children(node0)}
+
+        for child in hive1.node_children(node1):
+            name = hive1.node_name(child)
+
+            if name in children0:
+                nodes.append((children0.pop(name), child,
+                              ntpath.join(key, name), True))
+            else:
+                comparison['created_keys'].update(
+                    (k.path, (k.timestamp, k.values))
+                    for k in hive1.subtree_keys(child, key))
+
+        for child in children0.values():
+            comparison['deleted_keys'].extend(hive0.subtree_paths(child, key))
+
+    return comparison
+
+
+def same_key_metadata(hive0, node0, hive1, node1):
+    """Returns True if the two registry keys have the same
+    last modification timestamp and amount of values.
 
-    return registry_comparison(registry0, registry1)
+    """
+    return (hive0.node_timestamp(node0) == hive1.node_timestamp(node1) and
+            len(hive0.node_values(node0)) == len(hive1.node_values(node1)))
+
+
+def update_comparison(comparison, hive_comparison):
+    """Adds the differences of a single hive to the registry comparison.
+
+    Keys with the same path in multiple hives, as the HKCU ones
+    of different users, are reported once: their values are joined
+    and the latest timestamp is kept.
+
+    """
+    for kind, keys in hive_comparison.items():
+        if kind == 'deleted_keys':
+            deleted = set(comparison[kind])
+            comparison[kind].extend(k for k in keys if k not in deleted)
+            continue
+
+        for key, (timestamp, values) in keys.items():
+            if key in comparison[kind]:
+                previous, merged = comparison[kind][key]
+                timestamp = max(timestamp, previous)
+                values = merged + type(merged)(values)
+
+            comparison[kind][key] = timestamp, values
 
 
 def registry_comparison(registry0, registry1):
@@ -329,6 +1315,51 @@ def registry_comparison(registry0, registry1):
     return comparison
 
 
+def merge_registry_comparison(records0, records1):
+    """Compares two key path sorted iterables of registry records
+    as written by dump_registry_files returning their difference.
+
+    The marshalled values are decoded only for the differing keys.
+
+    """
+    comparison = {'created_keys': {},
+                  'deleted_keys': [],
+                  'created_values': {},
+                  'deleted_values': {},
+                  'modified_values': {}}
+    record0 = next(records0, None)
+    record1 = next(records1, None)
+
+    while record0 is not None or record1 is not None:
+        if record1 is None or (record0 is not None and
+                               record0[0] < record1[0]):
+            comparison['deleted_keys'].append(record0[0])
+            record0 = next(records0, None)
+        elif record0 is None or record1[0] < record0[0]:
+            key, timestamp, values = record1
+            comparison['created_keys'][key] = (timestamp,
+                                               marshal.loads(values))
+            record1 = next(records1, None)
+        else:
+            key, timestamp, values = record1
+
+            if values != record0[2]:
+                created, deleted, modified = compare_values(
+                    marshal.loads(record0[2]), marshal.loads(values))
+
+                if created:
+                    comparison['created_values'][key] = (timestamp, created)
+                if deleted:
+                    comparison['deleted_values'][key] = (timestamp, deleted)
+                if modified:
+                    comparison['modified_values'][key] = (timestamp, modified)
+
+            record0 = next(records0, None)
+            record1 = next(records1, None)
+
+    return comparison
+
+
 def compare_values(values0, values1):
     """Compares all the values of a single registry key."""
     values0 = {v[0]: v[1:] for v in values0}
@@ -376,43 +1407,73 @@ def files_type(fs0, fs1, files):
 
 def files_size(fs0, fs1, files):
     """Gets the file size of the given files."""
-    for file_meta in files['deleted_files']:
-        file_meta['size'] = fs0.stat(file_meta['path'])['size']
-    for file_meta in files['created_files'] + files['modified_files']:
-        file_meta['size'] = fs1.stat(file_meta['path'])['size']
+    for filesystem, files_meta in ((fs0, files['deleted_files']),
+                                   (fs1, files['created_files'] +
+                                    files['modified_files'])):
+        nodes = dict(filesystem.stats(f['path'] for f in files_meta))
+
+        for file_meta in (f for f in files_meta if f['path'] in nodes):
+            file_meta['size'] = nodes[file_meta['path']].size
 
     return files
 
 
-@concurrent.thread
-def concurrent_hash_filesystem(filesystem):
-    return hash_filesystem(filesystem)
+def hash_disk(disk, pool, cache, shards):
+    with FileSystem(disk, pool=pool) as filesystem:
+        return hash_filesystem(filesystem, shards=shards, cache=cache)
+
+
+def download_registry(filesystem, path, directory):
+    """Downloads the registry hive into the local directory
+    returning its local path.
 
+    """
+    descriptor, local_path = mkstemp(dir=directory)
+    os.close(descriptor)
+
+    filesystem.download(path, local_path)
+
+    return local_path
+
+
+def dump_registry_files(hives, directory):
+    """Parses the given (local_path, hive_path) downloaded registry hives
+    writing their keys sorted by path in a file within the directory.
+
+    The file contains a sequence of marshal records:
 
-def parse_registries(filesystem, registries):
-    """Returns a dictionary with the content of the given registry hives.
+        ("\\Registry\\Key", "timestamp", <marshalled values>)
 
-    {"\\Registry\\Key\\", (("ValueKey", "ValueType", ValueValue))}
+    The values are marshalled on their own allowing to compare them
+    without decoding. The records are read and diffed in place
+    rather than sending all the keys back to the parent process.
+
+    Returns the path of the records file.
 
     """
-    results = {}
+    keys = {}
+
+    for local_path, path in hives:
+        keys.update(parse_hive(local_path, path))
+
+    descriptor, records_path = mkstemp(dir=directory)
 
-    for path in registries:
-        with NamedTemporaryFile(buffering=0) as tempfile:
-            filesystem.download(path, tempfile.name)
+    with os.fdopen(descriptor, 'wb') as records:
+        for key in sorted(keys):
+            timestamp, values = keys[key]
+            # version 2 emits no references: equal values give equal bytes
+            values = marshal.dumps(values, MARSHAL_VERSION)
 
-            registry = RegistryHive(tempfile.name)
-            registry.rootkey = registry_root(path)
+            marshal.dump((key, timestamp, values), records, MARSHAL_VERSION)
 
-            results.update({k.path: (k.timestamp, k.values)
-                            for k in registry.keys()})
+    return records_path
 
-    return results
 
+def parse_hive(local_path, path):
+    registry = RegistryHive(local_path)
+    registry.rootkey = registry_root(path)
 
-@concurrent.process(timeout=300)
-def concurrent_parse_registries(filesystem, registries):
-    return parse_registries(filesystem, registries)
+    return {k.path: (k.timestamp, k.values) for k in registry.keys()}
 
 
 def makedirs(path):
@@ -421,3 +1482,9 @@ def makedirs(path):
 
     if not path.exists():
         path.mkdir(parents=True)
+
+
+MARSHAL_VERSION = 2
+MERGE_MEMORY_LIMIT = 64 * 1024 * 1024
+REGISTRY_SAMPLE = 0.01
+REGISTRY_TIMEOUT = 300
@@ -0,0 +1,162 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Executor running the concurrent tasks of the disk comparisons."""
+
+
+from contextlib import contextmanager
+from concurrent.futures import TimeoutError
+
+from pebble import ProcessPool, ThreadPool
+
+
+class TaskExecutor:
+    """Runs the concurrent comparison tasks on a shared pool of workers.
+
+    backend is either 'thread', 'process' or a caller supplied executor:
+    a pebble pool or any object exposing the concurrent.futures.Executor
+    submit method.
+    workers is the maximum amount of concurrent tasks per pool.
+    timeout is the maximum amount of seconds to wait for a task result,
+    process tasks exceeding it are terminated. Thread tasks cannot be
+    interrupted: once a result times out, or the executor context exits
+    on error, the pools are closed without waiting for the running threads
+    which are abandoned to complete in background.
+
+    Tasks handling GuestFS handles cannot be sent to other processes,
+    they are run by submit_io on a pool of threads.
+    CPU bound tasks are run by submit on the configured backend.
+
+    """
+    def __init__(self, backend='process', workers=2, timeout=None):
+        self.backend = backend
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = None
+        self._io_pool = None
+        self._expired = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error, *_):
+        self.close(wait=error is None)
+
+    def submit(self, function, *args, **kwargs):
+        """Runs the CPU bound function on the configured backend.
+
+        Returns a Future.
+
+        """
+        pool = self._backend_pool()
+
+        if isinstance(pool, ProcessPool):
+            return pool.schedule(function, args=args, kwargs=kwargs,
+                                 timeout=self.timeout)
+        elif isinstance(pool, ThreadPool):
+            return pool.schedule(function, args=args, kwargs=kwargs)
+        else:
+            return pool.submit(function, *args, **kwargs)
+
+    def submit_io(self, function, *args, **kwargs):
+        """Runs the function within a thread of the current process.
+
+        Returns a Future.
+
+        """
+        if self._io_pool is None:
+            self._io_pool = ThreadPool(max_workers=self.workers)
+
+        return self._io_pool.schedule(function, args=args, kwargs=kwargs)
+
+    def result(self, future, timeout=None):
+        """Waits for the future result for at most timeout seconds,
+        the executor timeout if None.
+
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            self._expired = True
+            future.cancel()
+            raise
+
+    def close(self, wait=True):
+        """Closes the pools owned by the executor.
+
+        If wait is True and no task timed out, the pending tasks
+        are waited for. Otherwise, the pending tasks are dropped,
+        the processes terminated and the running threads abandoned.
+
+        """
+        wait = wait and not self._expired
+
+        for pool in (p for p in (self._pool, self._io_pool)
+                     if p is not None):
+            if wait:
+                pool.close()
+                pool.join()
+            else:
+                pool.stop()
+                if isinstance(pool, ProcessPool):
+                    pool.join()
+
+        self._pool = self._io_pool = None
+        self._expired = False
+
+    def _backend_pool(self):
+        if not isinstance(self.backend, str):
+            return self.backend
+
+        if self._pool is None:
+            if self.backend == 'process':
+                self._pool = ProcessPool(max_workers=self.workers)
+            elif self.backend == 'thread':
+                self._pool = ThreadPool(max_workers=self.workers)
+            else:
+                raise ValueError("Unknown executor backend %s" % self.backend)
+
+        return self._pool
+
+
+@contextmanager
+def task_executor(executor=None, **defaults):
+    """Yields the given TaskExecutor or a new one built with the defaults
+    closed once the context is over.
+
+    """
+    if executor is not None:
+        yield executor
+    else:
+        with TaskExecutor(**defaults) as executor:
+            yield executor
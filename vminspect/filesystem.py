@@ -30,15 +30,25 @@
 
 """GuestFS wrapper to facilitate File System analysis."""
 
+import io
 import os
 import re
 import stat
+import heapq
+import hashlib
 import logging
-
-from tempfile import NamedTemporaryFile
+import marshal
+import tarfile
+import posixpath
+from pebble import concurrent, ProcessPool
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from tempfile import TemporaryFile
 
 from guestfs import GuestFS
 
+from vminspect.manifest import Manifest
+
 
 class FileSystem:
     """Convenience wrapper over GuestFS instance.
@@ -47,10 +57,16 @@ class FileSystem:
 
     Automatically translates paths according to the contained File System.
 
+    If an appliance pool is given, the GuestFS handle is borrowed from it
+    on mount and given back on umount.
+
     """
-    def __init__(self, disk_path):
+    def __init__(self, disk_path, pool=None):
         self._root = None
-        self._handler = GuestFS()
+        self._prefix = ''
+        self._inspection = None
+        self._pool = pool
+        self._handler = None
 
         self.disk_path = disk_path
 
@@ -65,68 +81,81 @@ class FileSystem:
     def __getattr__(self, attr):
         return getattr(self._handler, attr)
 
+    @property
+    def inspection(self):
+        """Returns the Inspection snapshot taken when mounting the disk."""
+        return self._inspection
+
     @property
     def osname(self):
         """Returns the Operating System name."""
-        return self._handler.inspect_get_type(self._root)
+        return self._inspection.ostype
 
     @property
     def fsroot(self):
         """Returns the file system root."""
-        if self.osname == 'windows':
-            return '{}:\\'.format(
-                self._handler.inspect_get_drive_mappings(self._root)[0][0])
+        if self._inspection.ostype == 'windows':
+            return '{}:\\'.format(self._inspection.drive)
         else:
-            return self._handler.inspect_get_mountpoints(self._root)[0][0]
+            return self._inspection.mountpoints[0][0]
 
     def mount(self, readonly=True):
         """Mounts the given disk.
         It must be called before any other method.
 
         """
-        self._handler.add_drive_opts(self.disk_path, readonly=True)
-        self._handler.launch()
+        if self._pool is not None:
+            handler = self._pool.acquire(self.disk_path)
+        else:
+            handler = launch_appliance(self.disk_path)
+
+        roots = handler.inspect_os()
+        if not roots:
+            raise RuntimeError("No OS found on the given disk image.")
+
+        self._attach(handler, roots[0], readonly=readonly)
+
+    def _attach(self, handler, root, prefix='', readonly=True):
+        """Mounts the OS found at root under the given prefix."""
+        self._handler = handler
+        self._root = root
+        self._prefix = prefix
+        self._inspection = inspect_root(handler, root)
+
+        mountpoints = sorted(self._inspection.mountpoints,
+                             key=lambda m: len(m[0]))
+
+        for mountpoint, device in mountpoints:
+            mountpoint = (prefix + mountpoint).rstrip('/') or '/'
 
-        for mountpoint, device in self._inspect_disk():
             if readonly:
-                self._handler.mount_ro(device, mountpoint)
+                handler.mount_ro(device, mountpoint)
             else:
-                self._handler.mount(device, mountpoint)
+                handler.mount(device, mountpoint)
 
-        if self._handler.inspect_get_type(self._root) == 'windows':
+        if self._inspection.ostype == 'windows':
             self.path = self._windows_path
         else:
             self.path = posix_path
 
-    def _inspect_disk(self):
-        """Inspects the disk and returns the mountpoints mapping
-        as a list which order is the supposed one for correct mounting.
-
-        """
-        roots = self._handler.inspect_os()
-
-        if roots:
-            self._root = roots[0]
-            return sorted(self._handler.inspect_get_mountpoints(self._root),
-                          key=lambda m: len(m[0]))
-        else:
-            raise RuntimeError("No OS found on the given disk image.")
-
     def umount(self):
         """Unmounts the disk.
 
         After this method is called no further action is allowed.
 
         """
-        self._handler.close()
+        if self._pool is not None:
+            self._pool.release(self._handler)
+        else:
+            self._handler.close()
 
     def download(self, source, destination):
         """Downloads the file on the disk at source into destination."""
-        self._handler.download(posix_path(source), destination)
+        self._handler.download(self._guest_path(source), destination)
 
     def ls(self, path):
         """Lists the content at the given path."""
-        return self._handler.ls(posix_path(path))
+        return self._handler.ls(self._guest_path(path))
 
     def nodes(self, path):
         """Iterates over the files and directories contained within the disk
@@ -137,11 +166,12 @@ class FileSystem:
         """
         path = posix_path(path)
 
-        yield from (self.path(path, e) for e in self._handler.find(path))
+        yield from (self.path(path, e)
+                    for e in self._handler.find(self._prefix + path))
 
     def checksum(self, path, hashtype='sha1'):
         """Returns the checksum of the given path."""
-        return self._handler.checksum(hashtype, posix_path(path))
+        return self._handler.checksum(hashtype, self._guest_path(path))
 
     def checksums(self, path, hashtype='sha1'):
         """Iterates over the files hashes contained within the disk
@@ -154,14 +184,96 @@ class FileSystem:
             "C:\\Windows\\System32\\NTUSER.DAT", "hash" for windows
             "/home/user/text.txt", "hash" for other FS
 
+        The hashes are yielded while the appliance is still computing them.
+        The GuestFS handle is busy until the iteration is over,
+        no other method must be called in the meantime.
+
+        """
+        path = posix_path(path)
+
+        with self._stream(self._handler.checksums_out,
+                          hashtype, self._guest_path(path)) as pipe:
+            for line in pipe:
+                checksum, name = line.decode('utf8').strip().split(None, 1)
+
+                yield self.path(path, relative_path(name)), checksum
+
+    def sampled_checksum(self, path, size, hashtype='sha1'):
+        """Returns a partial checksum of the file at the given path.
+
+        Only the file size and SAMPLES blocks of its content
+        are hashed: the head, the tail and evenly strided ones.
+
+        The checksum is labelled with the PARTIAL_PREFIX.
+
         """
-        with NamedTemporaryFile(buffering=0) as tempfile:
-            self._handler.checksums_out(hashtype, posix_path(path),
-                                        tempfile.name)
+        guest_path = self._guest_path(path)
+        digest = hashlib.new(hashtype)
+        digest.update(str(size).encode())
+
+        for offset in sample_offsets(size):
+            digest.update(self._handler.pread(guest_path, SAMPLE_BLOCK,
+                                              offset))
+
+        return PARTIAL_PREFIX + digest.hexdigest()
+
+    def digests(self, path, hashtypes=('sha1', )):
+        """Iterates over the files contained within the disk
+        starting from the given path computing all the given hashes.
+
+        The content is streamed as a tar archive and hashed locally,
+        each file is read only once whatever the amount of hashes.
 
-            yield from ((self.path(f[1].lstrip('.')), f[0])
-                        for f in (l.decode('utf8').strip().split(None, 1)
-                                  for l in tempfile))
+        Yields the path and a dictionary {hashtype: hash} for each file.
+
+        The GuestFS handle is busy until the iteration is over,
+        no other method must be called in the meantime.
+
+        """
+        path = posix_path(path)
+
+        with self._stream(self._handler.tar_out,
+                          self._guest_path(path)) as pipe:
+            with tarfile.open(fileobj=pipe, mode='r|') as archive:
+                for name, digests in archive_digests(archive, hashtypes):
+                    yield self.path(path, name), digests
+
+    def file_digests(self, paths, hashtypes=('sha1', )):
+        """Computes all the given hashes of the files at the given paths
+        reading each file only once.
+
+        The files contained within the same directory
+        are streamed as a single tar archive.
+
+        Yields the path and a dictionary {hashtype: hash} for each file,
+        the paths not referring to readable regular files are skipped.
+
+        """
+        directories = defaultdict(dict)
+
+        for path, node in self.stats(paths):
+            if stat.S_ISREG(node.mode):
+                directory, name = posixpath.split(posix_path(path))
+                directories[directory][name] = path
+
+        for directory, names in directories.items():
+            digests = []
+
+            try:
+                with self.archive(directory, names) as archive:
+                    for name, hashes in archive_digests(archive, hashtypes):
+                        if name in names:
+                            digests.append((names.pop(name), hashes))
+            except (RuntimeError, tarfile.TarError) as error:
+                logging.debug("Unable to archive %s: %s.", directory, error)
+
+            yield from digests
+
+            for path in names.values():
+                try:
+                    yield path, {h: self.checksum(path, h) for h in hashtypes}
+                except RuntimeError:
+                    logging.debug("Unable to hash %s.", path)
 
     def stat(self, path):
         """Retrieves the status of the node at the given path.
@@ -169,59 +281,788 @@ class FileSystem:
         Returns a dictionary.
 
         """
-        return self._handler.stat(posix_path(path))
+        return self._handler.stat(self._guest_path(path))
+
+    def stats(self, paths):
+        """Retrieves the status of the nodes at the given paths.
+
+        Symbolic links are not followed.
+
+        The nodes are queried in batches, one request per directory,
+        amortizing the appliance round trip over many paths.
+
+        Yields the path and a NodeStat namedtuple for each existing node.
+
+        """
+        directories = defaultdict(list)
+
+        for path in paths:
+            directory, name = posixpath.split(self._guest_path(path))
+            directories[directory].append((path, name))
+
+        for directory, entries in directories.items():
+            for index in range(0, len(entries), STAT_BATCH):
+                batch = entries[index:index + STAT_BATCH]
+                nodes = self._handler.lstatnslist(
+                    directory, [name for _, name in batch])
+
+                yield from ((path, node_stat(node))
+                            for (path, _), node in zip(batch, nodes)
+                            if node['st_ino'] >= 0)
+
+    def directory_stats(self, path):
+        """Retrieves the status of the nodes contained in the directory
+        at the given path.
+
+        Yields the path and a NodeStat namedtuple for each node.
+
+        """
+        path = posix_path(path)
+
+        yield from self.stats(self.path(path, name) for name in self.ls(path))
+
+    def disk_usage(self, path):
+        """Returns the disk space used by the given path in bytes.
+
+        Directories are walked recursively.
+
+        """
+        try:
+            return self._handler.du(self._guest_path(path)) * 1024
+        except RuntimeError:
+            return 0
 
     def file(self, path):
         """Analogous to Unix file command.
         Returns the type of node at the given path.
 
         """
-        return self._handler.file(posix_path(path))
+        return self._handler.file(self._guest_path(path))
 
     def exists(self, path):
         """Returns whether the path exists."""
-        return self._handler.exists(posix_path(path))
+        return self._handler.exists(self._guest_path(path))
 
     def path(self, *segments):
         """Normalizes the path returned by guestfs in the File System format."""
         raise NotImplementedError("FileSystem needs to be mounted first")
 
+    @contextmanager
+    def archive(self, path, names):
+        """Streams a tar archive of the given files
+        contained within the directory at path.
+
+        Only the nodes with the given names are included in the archive.
+
+        Yields a TarFile object to be read sequentially.
+
+        """
+        path = posix_path(path)
+        names = set(names)
+        excludes = [tar_pattern(name) for name in self.ls(path)
+                    if name not in names]
+
+        with self._stream(self._handler.tar_out, self._guest_path(path),
+                          excludes=excludes) as pipe:
+            with tarfile.open(fileobj=pipe, mode='r|') as archive:
+                yield archive
+
+    @contextmanager
+    def _stream(self, method, *args, **kwargs):
+        """Runs the given GuestFS download method streaming its output.
+
+        The method output is written into a pipe which can be read
+        while the appliance is still producing it.
+        The pipe buffer limits the amount of data in flight.
+
+        """
+        cancelled = False
+        rfd, wfd = os.pipe()
+        future = write_pipe(method, args, kwargs, wfd)
+
+        with os.fdopen(rfd, 'rb') as pipe:
+            try:
+                yield pipe
+            finally:
+                if not future.done():
+                    cancelled = True
+                    self._handler.user_cancel()
+
+                    while pipe.read(io.DEFAULT_BUFFER_SIZE):
+                        pass  # let the writer reach the end
+
+        try:
+            future.result()
+        except RuntimeError:
+            if not cancelled:
+                raise
+
+    def _guest_path(self, *segments):
+        """Translates the given path into the appliance one."""
+        return self._prefix + posix_path(*segments)
+
     def _windows_path(self, *segments):
-        drive = self._handler.inspect_get_drive_mappings(self._root)[0][0]
+        return "%s:%s" % (self._inspection.drive,
+                          os.path.join(*segments).replace('/', '\\'))
+
+
+class FileSystemGroup:
+    """Mounts multiple disks within a single GuestFS appliance.
+
+    Each disk's File System is mounted under its own prefix
+    (/disk0, /disk1, ...) and is accessible through
+    the related FileSystem object in the filesystems attribute.
+
+    The FileSystem objects share the same GuestFS handle,
+    they must not be unmounted individually.
+
+    """
+    def __init__(self, disks, pool=None):
+        self.disks = disks
+        self.filesystems = ()
+        self._pool = pool
+        self._handler = None
+
+    def __enter__(self):
+        self.mount()
+
+        return self
+
+    def __exit__(self, *_):
+        self.umount()
+
+    def mount(self, readonly=True):
+        """Mounts the given disks.
+        It must be called before any other method.
+
+        """
+        if self._pool is not None:
+            self._handler = self._pool.acquire(*self.disks)
+        else:
+            self._handler = launch_appliance(*self.disks)
+
+        roots = self._disk_roots()
+        filesystems = [FileSystem(disk) for disk in self.disks]
+
+        # mountpoints must be created before mounting anything on /
+        for index in range(len(filesystems)):
+            self._handler.mkmountpoint('/disk%d' % index)
+        for index, filesystem in enumerate(filesystems):
+            filesystem._attach(self._handler, roots[index],
+                               prefix='/disk%d' % index, readonly=readonly)
+
+        self.filesystems = tuple(filesystems)
+
+    def umount(self):
+        """Unmounts the disks.
+
+        After this method is called no further action is allowed.
+
+        """
+        if self._pool is not None:
+            try:
+                self._detach()
+            except RuntimeError as error:
+                logging.debug("Unable to remove mountpoints: %s.", error)
+                self._handler.close()
+            else:
+                self._pool.release(self._handler)
+        else:
+            self._handler.close()
+
+    def _detach(self):
+        """Unmounts the File Systems and removes their mountpoints
+        allowing the appliance to be reused.
+
+        umount_all is not compatible with mkmountpoint: the File Systems
+        are unmounted innermost first before removing the mountpoints.
+
+        """
+        mounted = dict(self._handler.mountpoints()).values()
+
+        for index in range(len(self.disks)):
+            prefix = '/disk%d' % index
+
+            for mountpoint in sorted((m for m in mounted
+                                      if m == prefix or
+                                      m.startswith(prefix + '/')),
+                                     key=len, reverse=True):
+                self._handler.umount(mountpoint)
 
-        return "%s:%s" % (drive, os.path.join(*segments).replace('/', '\\'))
+            self._handler.rmmountpoint(prefix)
 
+    def _disk_roots(self):
+        """Maps each disk to the root of the OS it contains."""
+        roots = {}
 
-def hash_filesystem(filesystem, hashtype='sha1'):
+        for root in self._handler.inspect_os():
+            try:
+                device = self._handler.part_to_dev(root)
+            except RuntimeError:
+                device = root
+
+            try:
+                roots.setdefault(self._handler.device_index(device), root)
+            except RuntimeError:
+                raise RuntimeError("Unable to map OS %s to its disk." % root)
+
+        try:
+            return [roots[index] for index in range(len(self.disks))]
+        except KeyError as error:
+            raise RuntimeError("No OS found on the disk image %s." %
+                               self.disks[error.args[0]])
+
+
+def inspect_root(handler, root):
+    """Collects the inspection data of the OS found at root.
+
+    Returns an Inspection namedtuple.
+
+    """
+    ostype = handler.inspect_get_type(root)
+    mountpoints = tuple(tuple(m) for m in handler.inspect_get_mountpoints(root))
+
+    if ostype == 'windows':
+        drive = handler.inspect_get_drive_mappings(root)[0][0]
+    else:
+        drive = None
+
+    return Inspection(root, tuple(handler.inspect_get_roots()),
+                      ostype, drive, mountpoints)
+
+
+def launch_appliance(*disks):
+    """Launches a GuestFS appliance with the given disks attached
+    in read only mode.
+
+    """
+    handler = GuestFS()
+
+    for disk in disks:
+        handler.add_drive_opts(disk, readonly=True)
+    handler.launch()
+
+    return handler
+
+
+def hash_filesystem(filesystem, hashtype='sha1', shards=1, cache=None,
+                    compact=False, file_filter=None, sample_threshold=None):
     """Utility function for running the files iterator at once.
 
+    If shards is greater than one, the File System content is split
+    in as many shards hashed concurrently by separate appliances.
+
+    If a ManifestCache is given, the hashes are loaded from it if present
+    and stored into it otherwise.
+
+    Returns a dictionary.
+
+        {'/path/on/filesystem': 'file_hash'}
+
+    If compact is True, or if the hashes come from the cache,
+    a read only Manifest with the same interface is returned instead.
+
+    If a FileFilter is given, only the selected files are hashed.
+    The shards option is not used in such case.
+
+    If sample_threshold is given, the files larger than it in bytes
+    are given a partial checksum (see FileSystem.sampled_checksum).
+    The shards, cache and compact options are not used in such case.
+
+    """
+    if sample_threshold is not None:
+        return sampled_hash_filesystem(filesystem, sample_threshold,
+                                       hashtype=hashtype,
+                                       file_filter=file_filter)
+
+    if cache is not None:
+        files = cache.load(filesystem.disk_path, hashtype=hashtype,
+                           file_filter=file_filter)
+        if files is not None:
+            return files
+
+    if file_filter is not None:
+        files = hash_nodes(filesystem,
+                           filter_nodes(filesystem, (('/', True), ),
+                                        file_filter),
+                           hashtype=hashtype)
+    elif shards > 1:
+        files = sharded_hash_filesystem(filesystem, hashtype=hashtype,
+                                        shards=shards)
+    else:
+        files = hash_directory(filesystem, '/', hashtype=hashtype)
+
+    if compact:
+        files = Manifest.from_items(files.items())
+
+    if cache is not None:
+        cache.store(filesystem.disk_path, files, hashtype=hashtype,
+                    file_filter=file_filter)
+
+    return files
+
+
+def sampled_hash_filesystem(filesystem, threshold, hashtype='sha1',
+                            file_filter=None):
+    """Hashes the File System content sampling the files
+    larger than threshold bytes.
+
+    Returns a dictionary, the partial checksums start with PARTIAL_PREFIX.
+
+        {'/path/on/filesystem': 'file_hash'}
+
+    """
+    sample_filter = SampleFilter(threshold, file_filter)
+    nodes = list(filter_nodes(filesystem, (('/', True), ), sample_filter))
+    files = hash_nodes(filesystem, nodes, hashtype=hashtype)
+
+    for path, size in sample_filter.sampled:
+        try:
+            files[path] = filesystem.sampled_checksum(path, size, hashtype)
+        except RuntimeError:
+            logging.debug("Unable to hash %s.", path)
+
+    return files
+
+
+class SampleFilter:
+    """Wraps the optional FileFilter setting aside
+    the files larger than threshold bytes to be sampled.
+
+    The set aside files are listed as (path, size) in the sampled attribute.
+
+    """
+    def __init__(self, threshold, file_filter=None):
+        self.threshold = threshold
+        self.file_filter = file_filter
+        self.sampled = []
+
+    def match(self, path, size=None, ignorecase=False):
+        if (self.file_filter is not None and
+                not self.file_filter.match(path, size, ignorecase)):
+            return False
+
+        if size is not None and size > self.threshold:
+            self.sampled.append((path, size))
+            return False
+
+        return True
+
+    def prune(self, path, ignorecase=False):
+        return (self.file_filter is not None and
+                self.file_filter.prune(path, ignorecase))
+
+
+def is_partial(checksum):
+    """Returns whether the checksum was computed sampling the file."""
+    return checksum.startswith(PARTIAL_PREFIX)
+
+
+def sample_offsets(size):
+    """Returns the offsets of the blocks sampled from a file of given size."""
+    if size <= SAMPLE_BLOCK * SAMPLES:
+        return range(0, size, SAMPLE_BLOCK)
+
+    last = size - SAMPLE_BLOCK
+
+    return sorted({index * last // (SAMPLES - 1) for index in range(SAMPLES)})
+
+
+def hash_directory(filesystem, path, hashtype='sha1'):
+    """Hashes the files contained within the given directory.
+
     Returns a dictionary.
 
         {'/path/on/filesystem': 'file_hash'}
 
+    """
+    return dict(directory_checksums(filesystem, path, hashtype=hashtype))
+
+
+def directory_checksums(filesystem, path, hashtype='sha1'):
+    """Iterates over the hashes of the files contained
+    within the given directory.
+
+    If the streamed hashing fails, the files are hashed one by one:
+    the paths already yielded are yielded again in such case.
+
+    Yields (path, hash) tuples.
+
     """
     try:
-        return dict(filesystem.checksums('/'))
+        yield from filesystem.checksums(path, hashtype=hashtype)
     except RuntimeError:
-        results = {}
-
         logging.warning("Error hashing disk %s contents, iterating over files.",
                         filesystem.disk_path)
 
-        for path in filesystem.nodes('/'):
+        for node_path, node in filesystem.stats(filesystem.nodes(path)):
+            if stat.S_ISREG(node.mode):
+                try:
+                    yield node_path, filesystem.checksum(node_path,
+                                                         hashtype=hashtype)
+                except RuntimeError:
+                    logging.debug("Unable to hash %s.", node_path)
+
+
+def sorted_checksums(filesystem, hashtype='sha1', memory_limit=None,
+                     file_filter=None):
+    """Returns the list of (path, hash) tuples of the files
+    contained within the disk sorted by path.
+
+    If memory_limit is given, the tuples are sorted in runs spilled
+    on temporary files whenever their size exceeds the limit in bytes.
+    An iterator lazily merging the runs is returned instead of a list.
+
+    If a FileFilter is given, only the selected files are hashed.
+
+    The hashes are streamed into the sort in any case,
+    including when falling back to hashing the files one by one.
+
+    """
+    nodes = (('/', True), )
+    if file_filter is not None:
+        nodes = filter_nodes(filesystem, nodes, file_filter)
+
+    checksums = node_checksums(filesystem, nodes, hashtype=hashtype)
+
+    if memory_limit is None:
+        return list(unique_paths(sorted(checksums)))
+    else:
+        return unique_paths(external_sort(checksums, memory_limit))
+
+
+def unique_paths(entries):
+    """Drops the path sorted (path, hash) tuples repeating the previous path.
+
+    Paths are repeated if the streamed hashing of a directory fails midway
+    and its files are hashed again one by one.
+
+    """
+    previous = None
+
+    for entry in entries:
+        if entry[0] != previous:
+            previous = entry[0]
+
+            yield entry
+
+
+def external_sort(iterable, memory_limit):
+    """Sorts the (path, hash) tuples within the given memory limit in bytes.
+
+    The iterable is consumed at once, the tuples exceeding the limit
+    are sorted in runs written on temporary files.
+
+    Returns an iterator merging the sorted runs.
+
+    """
+    runs = []
+    run = []
+    size = 0
+
+    try:
+        for entry in iterable:
+            run.append(entry)
+            size += sum(len(e) for e in entry) + ENTRY_OVERHEAD
+
+            if size >= memory_limit:
+                runs.append(spill_run(run))
+                run = []
+                size = 0
+    except BaseException:
+        for runfile in runs:
+            runfile.close()
+        raise
+
+    run.sort()
+
+    return merge_runs(runs, run)
+
+
+def spill_run(run):
+    """Writes the sorted run on a temporary file returning it."""
+    run.sort()
+    runfile = TemporaryFile()
+
+    for entry in run:
+        marshal.dump(entry, runfile)
+
+    runfile.seek(0)
+
+    return runfile
+
+
+def merge_runs(runs, run):
+    """Merges the sorted runs files with the last in memory run."""
+    try:
+        yield from heapq.merge(*(read_run(f) for f in runs), run)
+    finally:
+        for runfile in runs:
+            runfile.close()
+
+
+def read_run(runfile):
+    while True:
+        try:
+            yield marshal.load(runfile)
+        except EOFError:
+            return
+
+
+def stat_filesystem(filesystem, path='/'):
+    """Retrieves the metadata of the regular files contained
+    within the given directory.
+
+    Returns a dictionary.
+
+        {'/path/on/filesystem': NodeStat}
+
+    """
+    return {node_path: node for node_path, node
+            in filesystem.stats(filesystem.nodes(path))
+            if stat.S_ISREG(node.mode)}
+
+
+def stat_nodes(filesystem, nodes):
+    """Retrieves the metadata of the regular files among
+    the given list of (path, is_directory) nodes.
+
+    Directories are walked recursively.
+
+    Returns a dictionary.
+
+        {'/path/on/filesystem': NodeStat}
+
+    """
+    nodes = list(nodes)
+    results = {node_path: node for node_path, node
+               in filesystem.stats(p for p, d in nodes if not d)
+               if stat.S_ISREG(node.mode)}
+
+    for path in (p for p, directory in nodes if directory):
+        results.update(stat_filesystem(filesystem, path))
+
+    return results
+
+
+def sharded_hash_filesystem(filesystem, hashtype='sha1', shards=2):
+    """Hashes the File System content splitting it in shards.
+
+    The top level nodes are distributed across the shards
+    according to their size. Each shard is hashed by a separate process
+    mounting the disk on its own appliance.
+
+    Returns a dictionary.
+
+        {'/path/on/filesystem': 'file_hash'}
+
+    """
+    results = {}
+
+    with ProcessPool(max_workers=shards) as pool:
+        futures = [pool.schedule(hash_shard,
+                                 args=(filesystem.disk_path, hashtype, shard))
+                   for shard in split_shards(filesystem, shards) if shard]
+
+        for future in futures:
+            results.update(future.result())
+
+    return results
+
+
+def split_shards(filesystem, shards):
+    """Splits the top level nodes of the File System in balanced shards.
+
+    Returns a list of lists of (path, is_directory) tuples.
+
+    """
+    nodes = []
+    buckets = [(0, index, []) for index in range(shards)]
+
+    for path, node in filesystem.directory_stats('/'):
+        if stat.S_ISDIR(node.mode):
+            nodes.append((filesystem.disk_usage(path), path, True))
+        elif stat.S_ISREG(node.mode):
+            nodes.append((node.size, path, False))
+
+    for size, path, directory in sorted(nodes, reverse=True):
+        load, index, shard = heapq.heappop(buckets)
+        shard.append((path, directory))
+        heapq.heappush(buckets, (load + size, index, shard))
+
+    return [shard for _, _, shard in sorted(buckets, key=lambda b: b[1])]
+
+
+def hash_shard(disk, hashtype, nodes):
+    """Mounts the disk and hashes the given nodes."""
+    with FileSystem(disk) as filesystem:
+        return hash_nodes(filesystem, nodes, hashtype=hashtype)
+
+
+def filter_nodes(filesystem, nodes, file_filter):
+    """Applies the FileFilter to the given list of (path, is_directory) nodes
+    relying on the files metadata only.
+
+    Directories are walked skipping the excluded ones.
+    The directories which content is entirely selected are yielded as such
+    to be hashed at once, the selected files of the others individually.
+
+    Yields (path, is_directory) tuples.
+
+    """
+    ignorecase = filesystem.osname == 'windows'
+    nodes = list(nodes)
+    sizes = dict(filesystem.stats(p for p, directory in nodes
+                                  if not directory))
+
+    for path, directory in nodes:
+        if directory:
+            if not file_filter.prune(path, ignorecase):
+                clean, selected = filter_directory(filesystem, path,
+                                                   file_filter, ignorecase)
+
+                yield from clean and ((path, True), ) or selected
+        elif path in sizes and file_filter.match(path, sizes[path].size,
+                                                 ignorecase):
+            yield path, False
+
+
+def filter_directory(filesystem, path, file_filter, ignorecase):
+    """Walks the directory applying the FileFilter.
+
+    Returns whether all its files are selected
+    and the list of selected (path, is_directory) nodes.
+
+    """
+    clean = True
+    selected = []
+
+    for node_path, node in filesystem.directory_stats(path):
+        if stat.S_ISDIR(node.mode):
+            if file_filter.prune(node_path, ignorecase):
+                clean = False
+                continue
+
+            subclean, subselected = filter_directory(
+                filesystem, node_path, file_filter, ignorecase)
+
+            clean = clean and subclean
+            selected.extend(subclean and [(node_path, True)] or subselected)
+        elif stat.S_ISREG(node.mode):
+            if file_filter.match(node_path, node.size, ignorecase):
+                selected.append((node_path, False))
+            else:
+                clean = False
+
+    return clean, selected
+
+
+def hash_nodes(filesystem, nodes, hashtype='sha1'):
+    """Hashes the given list of (path, is_directory) nodes.
+
+    Directories are hashed recursively.
+
+    Returns a dictionary.
+
+        {'/path/on/filesystem': 'file_hash'}
+
+    """
+    return dict(node_checksums(filesystem, nodes, hashtype=hashtype))
+
+
+def node_checksums(filesystem, nodes, hashtype='sha1'):
+    """Iterates over the hashes of the given (path, is_directory) nodes
+    as hash_nodes without collecting them.
+
+    Yields (path, hash) tuples.
+
+    """
+    for path, directory in nodes:
+        if directory:
+            yield from directory_checksums(filesystem, path, hashtype)
+        else:
             try:
-                regular = stat.S_ISREG(filesystem.stat(path)['mode'])
+                yield path, filesystem.checksum(path, hashtype)
             except RuntimeError:
-                continue  # unaccessible node
+                logging.debug("Unable to hash %s.", path)
+
+
+@concurrent.thread
+def write_pipe(method, args, kwargs, fd):
+    """Runs the GuestFS method writing its output into the given pipe."""
+    try:
+        method(*(args + ('/dev/fd/%d' % fd, )), **kwargs)
+    finally:
+        os.close(fd)
+
+
+def node_stat(node):
+    """Builds a NodeStat namedtuple from the given GuestFS statns."""
+    return NodeStat(node['st_size'], node['st_mode'], node['st_ino'],
+                    node['st_atime_sec'] + node['st_atime_nsec'] / 10**9,
+                    node['st_mtime_sec'] + node['st_mtime_nsec'] / 10**9,
+                    node['st_ctime_sec'] + node['st_ctime_nsec'] / 10**9)
 
-            if regular:
-                try:
-                    results[path] = filesystem.checksum(path, hashtype=hashtype)
-                except RuntimeError:
-                    logging.debug("Unable to hash %s.", path)
 
-        return results
+def archive_digests(archive, hashtypes):
+    """Hashes the regular files contained within the tar archive.
+
+    Hard links are given the hashes of the file they refer to.
+
+    Yields the member name and a dictionary {hashtype: hash}.
+
+    """
+    files = {}
+
+    for member in archive:
+        name = relative_path(member.name)
+
+        if member.isfile():
+            files[name] = stream_digests(archive.extractfile(member),
+                                         hashtypes)
+        elif member.islnk() and relative_path(member.linkname) in files:
+            files[name] = files[relative_path(member.linkname)]
+        else:
+            continue
+
+        yield name, files[name]
+
+
+def stream_digests(fileobj, hashtypes):
+    """Computes all the given hashes reading the file once."""
+    hashes = [(h, hashlib.new(h)) for h in hashtypes]
+
+    for chunk in iter(lambda: fileobj.read(HASH_CHUNK), b''):
+        for _, digest in hashes:
+            digest.update(chunk)
+
+    return {h: digest.hexdigest() for h, digest in hashes}
+
+
+def tar_pattern(name):
+    """Escapes the wildcards within the name for tar exclusion patterns."""
+    return re.sub(r'([\\*?\[])', r'\\\1', name)
+
+
+def relative_path(name):
+    """Strips the leading ./ from the paths reported by find."""
+    return name[2:] if name.startswith('./') else name
 
 
 def posix_path(*segments):
     return re.sub('^[a-zA-Z]:', '', os.path.join(*segments)).replace('\\', '/')
+
+
+STAT_BATCH = 1000
+HASH_CHUNK = 1024 * 1024
+SAMPLES = 16
+SAMPLE_BLOCK = 64 * 1024
+PARTIAL_PREFIX = 'partial:'
+# estimated memory footprint of a (path, hash) tuple besides its strings
+ENTRY_OVERHEAD = 200
+
+
+NodeStat = namedtuple('NodeStat', ('size', 'mode', 'inode',
+                                   'atime', 'mtime', 'ctime'))
+Inspection = namedtuple('Inspection', ('root', 'roots', 'ostype',
+                                       'drive', 'mountpoints'))
@@ -0,0 +1,127 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Filters selecting the files to be hashed and compared."""
+
+
+import re
+import json
+import fnmatch
+import posixpath
+
+from vminspect.filesystem import posix_path
+
+
+class FileFilter:
+    """Selects files according to their path and size.
+
+    include and exclude are lists of patterns. Patterns are shell globs
+    unless prefixed with 're:', in which case they are regular expressions
+    searched within the whole path.
+    Globs containing a slash are matched against the whole path,
+    the other ones against the file name only.
+
+    Paths are matched in POSIX format: C:\\Windows becomes /Windows.
+
+    A file is selected if it matches any include pattern, if given,
+    none of the exclude ones and its size does not exceed max_size.
+    Directories matching an exclude pattern are not walked at all.
+
+    """
+    def __init__(self, include=(), exclude=(), max_size=None):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.max_size = max_size
+        self._patterns = {}
+
+    def __repr__(self):
+        return "%s(include=%r, exclude=%r, max_size=%r)" % (
+            self.__class__.__name__, self.include, self.exclude, self.max_size)
+
+    @property
+    def key(self):
+        """String uniquely identifying the filter rules."""
+        return json.dumps((self.include, self.exclude, self.max_size))
+
+    def match(self, path, size=None, ignorecase=False):
+        """Returns whether the file at path with the given size is selected.
+
+        ignorecase must be True for case insensitive File Systems.
+
+        """
+        if (self.max_size is not None and size is not None and
+                size > self.max_size):
+            return False
+
+        include, exclude = self._compiled(ignorecase)
+        path = posix_path(path)
+
+        if include and not any(matches(p, path) for p in include):
+            return False
+
+        return not any(matches(p, path) for p in exclude)
+
+    def prune(self, path, ignorecase=False):
+        """Returns whether the directory at path is excluded."""
+        _, exclude = self._compiled(ignorecase)
+        path = posix_path(path)
+
+        return any(matches(p, path) for p in exclude)
+
+    def _compiled(self, ignorecase):
+        if ignorecase not in self._patterns:
+            flags = re.IGNORECASE if ignorecase else 0
+
+            self._patterns[ignorecase] = (
+                [compile_pattern(p, flags) for p in self.include],
+                [compile_pattern(p, flags) for p in self.exclude])
+
+        return self._patterns[ignorecase]
+
+
+def compile_pattern(pattern, flags=0):
+    """Compiles the pattern returning a (function, whole_path) tuple."""
+    if pattern.startswith(REGEX_PREFIX):
+        return re.compile(pattern[len(REGEX_PREFIX):], flags).search, True
+    else:
+        return (re.compile(fnmatch.translate(pattern), flags).match,
+                '/' in pattern)
+
+
+def matches(pattern, path):
+    function, whole_path = pattern
+
+    if not whole_path:
+        path = posixpath.basename(path)
+
+    return function(path) is not None
+
+
+REGEX_PREFIX = 're:'
@@ -0,0 +1,111 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Disk image format helpers."""
+
+
+import os
+import json
+import struct
+import subprocess
+
+
+def image_identity(disk):
+    """Returns the identity of the disk image and of its backing chain.
+
+    The identity is a list of (path, size, modification time) tuples.
+
+    """
+    identity = []
+    path = os.path.realpath(disk)
+
+    while path is not None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            identity.append((path, None, None))
+            break
+
+        identity.append((path, stat.st_size, stat.st_mtime_ns))
+        path = qcow2_backing_file(path)
+
+    return identity
+
+
+def qcow2_backing_file(path):
+    """Returns the path of the backing file of the given QCOW2 image.
+
+    Returns None if the image is not QCOW2 or has no backing file.
+
+    """
+    with open(path, 'rb') as image:
+        header = image.read(QCOW2_HEADER.size)
+
+        if len(header) < QCOW2_HEADER.size:
+            return None
+
+        magic, _, offset, size = QCOW2_HEADER.unpack(header)
+        if magic != QCOW2_MAGIC or offset == 0:
+            return None
+
+        image.seek(offset)
+        backing_file = os.fsdecode(image.read(size))
+
+    return os.path.realpath(
+        os.path.join(os.path.dirname(path), backing_file))
+
+
+def overlay_extents(overlay, base):
+    """Returns the byte ranges of the overlay image
+    written after the base image in its backing chain.
+
+    The ranges are reported as a list of (start, end) tuples.
+
+    """
+    chain = [path for path, _, _ in image_identity(overlay)]
+    base = os.path.realpath(base)
+
+    if base not in chain[1:]:
+        raise RuntimeError("%s is not an overlay of %s" % (overlay, base))
+
+    depth = chain.index(base)
+
+    try:
+        output = subprocess.check_output(
+            ('qemu-img', 'map', '--output=json', overlay))
+    except (OSError, subprocess.CalledProcessError) as error:
+        raise RuntimeError("Unable to map %s: %s" % (overlay, error))
+
+    return [(e['start'], e['start'] + e['length'])
+            for e in json.loads(output.decode('utf8')) if e['depth'] < depth]
+
+
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_HEADER = struct.Struct('>4sIQI')
@@ -37,10 +37,14 @@ from collections import OrderedDict
 from tempfile import NamedTemporaryFile
 
 from vminspect.vtscan import VTScanner
+from vminspect.cache import ManifestCache
+from vminspect.executor import TaskExecutor
+from vminspect.filters import FileFilter
+from vminspect.store import ContentStore
 from vminspect.usnjrnl import usn_journal
 from vminspect.winevtx import WinEventLog
 from vminspect.vulnscan import VulnScanner
-from vminspect.comparator import DiskComparator
+from vminspect.comparator import DiskComparator, compare_chain
 from vminspect.timeline import FSTimeline, NTFSTimeline
 from vminspect.winreg import RegistryHive, registry_root
 from vminspect.filesystem import FileSystem, hash_filesystem, posix_path
@@ -61,16 +65,23 @@ def main():
 
 def list_files_command(arguments):
     return list_files(arguments.disk, identify=arguments.identify,
-                      size=arguments.size)
+                      size=arguments.size, shards=arguments.shards,
+                      cache=manifest_cache(arguments),
+                      file_filter=file_filter(arguments),
+                      sample_threshold=sample_threshold(arguments))
 
 
-def list_files(disk, identify=False, size=False):
+def list_files(disk, identify=False, size=False, shards=1, cache=None,
+               file_filter=None, sample_threshold=None):
     logger = logging.getLogger('filesystem')
 
     with FileSystem(disk) as filesystem:
         logger.debug("Listing files.")
 
-        files = hash_filesystem(filesystem)
+        files = hash_filesystem(filesystem, shards=shards, cache=cache,
+                                file_filter=file_filter,
+                                sample_threshold=sample_threshold)
+        files = [{'path': path, 'sha1': sha1} for path, sha1 in files.items()]
 
         if identify:
             logger.debug("Gatering file types.")
@@ -79,40 +90,81 @@ def list_files(disk, identify=False, size=False):
 
         if size:
             logger.debug("Gatering file sizes.")
-            for file_meta in files:
-                file_meta['size'] = filesystem.stat(file_meta['path'])['size']
+            nodes = dict(filesystem.stats(f['path'] for f in files))
+
+            for file_meta in (f for f in files if f['path'] in nodes):
+                file_meta['size'] = nodes[file_meta['path']].size
 
     return files
 
 
 def compare_command(arguments):
-    return compare_disks(arguments.disk1, arguments.disk2,
-                         identify=arguments.identify, size=arguments.size,
-                         extract=arguments.extract, path=arguments.path,
-                         registry=arguments.registry,
-                         concurrent=arguments.concurrent)
+    with task_executor(arguments) as executor:
+        return compare_disks(arguments.disk1, arguments.disk2,
+                             identify=arguments.identify, size=arguments.size,
+                             extract=arguments.extract, path=arguments.path,
+                             registry=arguments.registry,
+                             merkle=arguments.merkle,
+                             fast_registry=arguments.fast_registry,
+                             registry_sample=arguments.registry_sample,
+                             concurrent=arguments.concurrent,
+                             shared=arguments.shared, shards=arguments.shards,
+                             cache=manifest_cache(arguments),
+                             overlay=arguments.overlay, quick=arguments.quick,
+                             workers=arguments.extract_workers,
+                             store=content_store(arguments),
+                             memory_limit=memory_limit(arguments),
+                             file_filter=file_filter(arguments),
+                             sample_threshold=sample_threshold(arguments),
+                             executor=executor)
 
 
 def compare_disks(disk1, disk2, identify=False, size=False, registry=False,
-                  extract=False, path='.', concurrent=False):
-    with DiskComparator(disk1, disk2) as comparator:
+                  merkle=False, fast_registry=False, registry_sample=None,
+                  extract=False, path='.', concurrent=False, shared=False,
+                  shards=1, cache=None, overlay=False, quick=False,
+                  workers=1, store=None, memory_limit=None, file_filter=None,
+                  sample_threshold=None, executor=None):
+    with DiskComparator(disk1, disk2, shared=shared, cache=cache,
+                        executor=executor) as comparator:
         results = comparator.compare(concurrent=concurrent,
                                      identify=identify,
-                                     size=size)
+                                     size=size,
+                                     shards=shards,
+                                     overlay=overlay,
+                                     quick=quick,
+                                     memory_limit=memory_limit,
+                                     file_filter=file_filter,
+                                     sample_threshold=sample_threshold)
         if extract:
             extract = results['created_files'] + results['modified_files']
-            files = comparator.extract(1, extract, path=path)
+            files = comparator.extract(1, extract, path=path, workers=workers,
+                                       store=store)
 
             results.update(files)
 
         if registry:
-            registry = comparator.compare_registry(concurrent=concurrent)
+            registry = comparator.compare_registry(concurrent=concurrent,
+                                                   merkle=merkle,
+                                                   fast=fast_registry,
+                                                   sample=registry_sample)
 
             results['registry'] = registry
 
     return results
 
 
+def chain_command(arguments):
+    comparisons = compare_chain(arguments.disks, shards=arguments.shards,
+                                cache=manifest_cache(arguments),
+                                prefetch=arguments.prefetch)
+
+    for disk0, disk1, results in comparisons:
+        results.update({'disk0': disk0, 'disk1': disk1})
+
+        print(json.dumps(results, indent=2), flush=True)
+
+
 def registry_command(arguments):
     return parse_registry(
         arguments.hive, disk=arguments.disk, sort=arguments.sort)
@@ -143,11 +195,13 @@ def extract_registry(filesystem, path):
 
 
 def vtscan_command(arguments):
-    with VTScanner(arguments.disk, arguments.apikey) as vtscanner:
+    with VTScanner(arguments.disk, arguments.apikey,
+                   cache=manifest_cache(arguments)) as vtscanner:
         vtscanner.batchsize = arguments.batchsize
         filetypes = arguments.types and arguments.types.split(',') or None
 
-        return [r._asdict() for r in vtscanner.scan(filetypes=filetypes)]
+        return [r._asdict() for r in vtscanner.scan(
+            filetypes=filetypes, file_filter=file_filter(arguments))]
 
 
 def vulnscan_command(arguments):
@@ -169,7 +223,7 @@ def parse_usnjrnl(usnjrnl, disk=None):
 
 def extract_usnjrnl(filesystem, path):
     with NamedTemporaryFile(buffering=0) as tempfile:
-        root = filesystem.inspect_get_roots()[0]
+        root = filesystem.inspection.root
         inode = filesystem.stat(path)['ino']
         filesystem.download_inode(root, inode, tempfile.name)
 
@@ -188,7 +242,8 @@ def timeline_command(arguments):
 
         if arguments.hash:
             logger.debug("Gatering file hashes.")
-            events = calculate_hashes(timeline, events)
+            events = calculate_hashes(timeline, events,
+                                      hashtypes=hash_types(arguments))
 
     return events
 
@@ -205,15 +260,18 @@ def usnjrnl_timeline_command(arguments):
 
         if arguments.hash:
             logger.debug("Gatering file hashes.")
-            events = calculate_hashes(timeline, events)
+            events = calculate_hashes(timeline, events,
+                                      hashtypes=hash_types(arguments))
 
         if arguments.extract:
             logger.debug("Extracting created files.")
-            extract_created_files(timeline, arguments.extract, events)
+            extract_created_files(timeline, arguments.extract, events,
+                                  store=content_store(arguments))
 
         if arguments.recover:
             logger.debug("Recovering deleted files.")
-            extract_deleted_files(timeline, arguments.recover, events)
+            extract_deleted_files(timeline, arguments.recover, events,
+                                  store=content_store(arguments))
 
     return events
 
@@ -228,20 +286,25 @@ def identify_files(timeline, events):
     return events
 
 
-def calculate_hashes(timeline, events):
-    for event in (e for e in events if e['allocated']):
-        try:
-            event['hash'] = timeline.checksum(event['path'])
-        except RuntimeError:
-            pass
+def calculate_hashes(timeline, events, hashtypes=()):
+    hashtypes = ('sha1', ) + tuple(h for h in hashtypes if h != 'sha1')
+    paths = {e['path'] for e in events if e['allocated']}
+    digests = dict(timeline.file_digests(paths, hashtypes=hashtypes))
+
+    for event in (e for e in events
+                  if e['allocated'] and e['path'] in digests):
+        event['hash'] = digests[event['path']]['sha1']
+
+        if len(hashtypes) > 1:
+            event['hashes'] = digests[event['path']]
 
     return events
 
 
-def extract_created_files(timeline, path, events):
+def extract_created_files(timeline, path, events, store=None):
     path = Path(path)
 
-    if not path.exists():
+    if store is None and not path.exists():
         path.mkdir(parents=True)
 
     for event in (e for e in events
@@ -255,17 +318,22 @@ def extract_created_files(timeline, path, events):
             name = Path(posix_path(event['path'])).name
             destination = Path(path, '_'.join((sha_hash, name)))
 
-            if not destination.exists():
+            if store is not None:
+                if not store.reference(sha_hash):
+                    with NamedTemporaryFile(buffering=0) as tempfile:
+                        timeline.download(source, tempfile.name)
+                        store.add(sha_hash, tempfile)
+            elif not destination.exists():
                 timeline.download(source, str(destination))
         except RuntimeError:
             pass
 
 
-def extract_deleted_files(timeline, path, events):
+def extract_deleted_files(timeline, path, events, store=None):
     path = Path(path)
-    root = timeline.inspect_get_roots()[0]
+    root = timeline.inspection.root
 
-    if not path.exists():
+    if store is None and not path.exists():
         path.mkdir(parents=True)
 
     for event in (e for e in events if 'FILE_DELETE' in e['changes']):
@@ -279,7 +347,11 @@ def extract_deleted_files(timeline, path, events):
                 sha_hash = hashlib.sha1(tempfile.read()).hexdigest()
                 destination = Path(path, '_'.join((sha_hash, name)))
 
-                shutil.copy(tempfile.name, str(destination))
+                if store is not None:
+                    tempfile.seek(0)
+                    store.add(sha_hash, tempfile)
+                else:
+                    shutil.copy(tempfile.name, str(destination))
 
                 event['hash'] = sha_hash
                 event['recovered'] = True
@@ -292,6 +364,73 @@ def eventlog_command(arguments):
         print('\n'.join(eventlog.eventlog(arguments.path)))
 
 
+def sample_threshold(arguments):
+    if arguments.sample_threshold:
+        return arguments.sample_threshold
+
+
+def task_executor(arguments):
+    return TaskExecutor(backend=arguments.executor, workers=arguments.workers,
+                        timeout=arguments.timeout or None)
+
+
+def manifest_cache(arguments):
+    if arguments.cache:
+        return ManifestCache(arguments.cache,
+                             max_size=arguments.cache_size * 1024**2)
+
+
+def memory_limit(arguments):
+    if arguments.memory_limit:
+        return arguments.memory_limit * 1024**2
+
+
+def file_filter(arguments):
+    if arguments.include or arguments.exclude or arguments.max_size:
+        return FileFilter(include=arguments.include,
+                          exclude=arguments.exclude,
+                          max_size=arguments.max_size or None)
+
+
+def hash_types(arguments):
+    return arguments.hashtypes and arguments.hashtypes.split(',') or ()
+
+
+def content_store(arguments):
+    if arguments.store:
+        return ContentStore(arguments.store,
+                            compression=arguments.compression)
+
+
+def add_store_arguments(parser):
+    parser.add_argument('--store', type=str, default='',
+                        help='path to the content addressed files store')
+    parser.add_argument('--compression', type=str, default=None,
+                        choices=('gzip', 'zstd'),
+                        help='compression of the files in the store')
+
+
+def add_filter_arguments(parser):
+    parser.add_argument('--include', type=str, action='append', default=[],
+                        help='glob or re:REGEX of the files to include')
+    parser.add_argument('--exclude', type=str, action='append', default=[],
+                        help='glob or re:REGEX of the files to exclude')
+    parser.add_argument('--max-size', type=int, default=0,
+                        help='maximum size in bytes of the files to include')
+
+
+def add_sample_arguments(parser):
+    parser.add_argument('--sample-threshold', type=int, default=0,
+                        help='partially hash files larger than these bytes')
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache', type=str, default='',
+                        help='path to the disk hashes cache')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='maximum size of the disk hashes cache in MB')
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Inspects VM disk images.')
     parser.add_argument('-d', '--debug', action='store_true', default=False,
@@ -307,6 +446,11 @@ def parse_arguments():
                              default=False, help='report file types')
     list_parser.add_argument('-s', '--size', action='store_true',
                              default=False, help='report file sizes')
+    list_parser.add_argument('--shards', type=int, default=1,
+                             help='amount of appliances hashing the disk')
+    add_cache_arguments(list_parser)
+    add_filter_arguments(list_parser)
+    add_sample_arguments(list_parser)
 
     compare_parser = subparsers.add_parser('compare',
                                            help='Compares two disks.')
@@ -320,12 +464,56 @@ def parse_arguments():
                                 default=False, help='extract new files')
     compare_parser.add_argument('-p', '--path', type=str, default='.',
                                 help='path where to extract files')
+    compare_parser.add_argument('--extract-workers', type=int, default=1,
+                                help='amount of processes extracting files')
     compare_parser.add_argument('-i', '--identify', action='store_true',
                                 default=False, help='report file types')
     compare_parser.add_argument('-s', '--size', action='store_true',
                                 default=False, help='report file sizes')
     compare_parser.add_argument('-r', '--registry', action='store_true',
                                 default=False, help='compare registry')
+    compare_parser.add_argument('--merkle', action='store_true',
+                                default=False,
+                                help='skip identical registry subtrees')
+    compare_parser.add_argument('--fast-registry', action='store_true',
+                                default=False,
+                                help='skip values of keys with same timestamp')
+    compare_parser.add_argument('--registry-sample', type=float, default=None,
+                                help='fraction of skipped keys to compare')
+    compare_parser.add_argument('--shared', action='store_true',
+                                default=False,
+                                help='mount both disks in a single appliance')
+    compare_parser.add_argument('--shards', type=int, default=1,
+                                help='amount of appliances hashing each disk')
+    compare_parser.add_argument('--overlay', action='store_true',
+                                default=False,
+                                help='second disk is a QCOW2 overlay of first')
+    compare_parser.add_argument('-q', '--quick', action='store_true',
+                                default=False,
+                                help='hash only files with different metadata')
+    compare_parser.add_argument('--memory-limit', type=int, default=0,
+                                help='spill hashes on disk beyond this MB')
+    compare_parser.add_argument('--executor', type=str, default='process',
+                                choices=('thread', 'process'),
+                                help='workers running the CPU bound tasks')
+    compare_parser.add_argument('--workers', type=int, default=2,
+                                help='amount of concurrent workers')
+    compare_parser.add_argument('--timeout', type=int, default=0,
+                                help='maximum seconds per concurrent task')
+    add_cache_arguments(compare_parser)
+    add_filter_arguments(compare_parser)
+    add_sample_arguments(compare_parser)
+    add_store_arguments(compare_parser)
+
+    chain_parser = subparsers.add_parser(
+        'chain', help='Compares each consecutive pair of a disks chain.')
+    chain_parser.add_argument('disks', type=str, nargs='+',
+                              help='path to disk images in chain order')
+    chain_parser.add_argument('--shards', type=int, default=1,
+                              help='amount of appliances hashing each disk')
+    chain_parser.add_argument('--prefetch', type=int, default=1,
+                              help='amount of disks hashed in advance')
+    add_cache_arguments(chain_parser)
 
     registry_parser = subparsers.add_parser(
         'registry', help='Lists the content of a registry file.')
@@ -345,6 +533,8 @@ def parse_arguments():
     vtscan_parser.add_argument(
         '-t', '--types', type=str, default='',
         help='comma separated list of file types (REGEX) to be scanned')
+    add_cache_arguments(vtscan_parser)
+    add_filter_arguments(vtscan_parser)
 
     vulnscan_parser = subparsers.add_parser(
         'vulnscan', help='Scans a disk and queries VBE.')
@@ -370,6 +560,9 @@ def parse_arguments():
                                  action='store_true', help='report file types')
     timeline_parser.add_argument('-s', '--hash', action='store_true',
                                  default=False, help='report file hash (SHA1)')
+    timeline_parser.add_argument(
+        '--hashtypes', type=str, default='',
+        help='comma separated list of additional hashes (md5,sha256...)')
 
     usnjrnl_timeline_parser = subparsers.add_parser(
         'usnjrnl_timeline', help="""Parses the NTFS Update Sequence Number
@@ -382,12 +575,16 @@ def parse_arguments():
     usnjrnl_timeline_parser.add_argument('-s', '--hash', action='store_true',
                                          default=False,
                                          help='report file hash (SHA1)')
+    usnjrnl_timeline_parser.add_argument(
+        '--hashtypes', type=str, default='',
+        help='comma separated list of additional hashes (md5,sha256...)')
     usnjrnl_timeline_parser.add_argument('-e', '--extract', type=str,
                                          default='',
                                          help='Extract created files into path')
     usnjrnl_timeline_parser.add_argument('-r', '--recover', type=str,
                                          default='',
                                          help='Try recovering deleted files')
+    add_store_arguments(usnjrnl_timeline_parser)
 
     eventlog_parser = subparsers.add_parser(
         'eventlog', help="""Parses the given Windows Event Log.""")
@@ -399,6 +596,7 @@ def parse_arguments():
 
 COMMANDS = {'list': list_files_command,
             'compare': compare_command,
+            'chain': chain_command,
             'registry': registry_command,
             'vtscan': vtscan_command,
             'vulnscan': vulnscan_command,
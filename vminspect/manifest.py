@@ -0,0 +1,260 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Compact representation of the File System hash manifests."""
+
+
+import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+from collections.abc import ItemsView, Mapping
+
+
+class Manifest(Mapping):
+    """Read only mapping of file paths to their hashes.
+
+    The paths are kept sorted and front coded: each path only stores
+    the suffix differing from the previous one. The raw digests
+    are stored in a contiguous buffer.
+    Every BLOCK_SIZE entries the full path is stored allowing
+    to binary search the manifest.
+
+    The manifest behaves as a dictionary:
+
+        {'/path/on/filesystem': 'file_hash'}
+
+    Iterating over the manifest yields the paths in sorted order.
+
+    """
+    def __init__(self, count, digest_size, offsets, digests, paths):
+        self._count = count
+        self._digest_size = digest_size
+        self._offsets = offsets
+        self._digests = digests
+        self._paths = paths
+        self._mmap = None
+
+    @classmethod
+    def from_items(cls, items):
+        """Builds the manifest from an iterable of (path, hexdigest)."""
+        digest_size = None
+        offsets = array('Q')
+        digests = bytearray()
+        paths = bytearray()
+        previous = b''
+
+        for index, (path, digest) in enumerate(sorted(items)):
+            path = path.encode('utf8', 'surrogateescape')
+            digest = bytes.fromhex(digest)
+
+            if digest_size is None:
+                digest_size = len(digest)
+            elif len(digest) != digest_size:
+                raise ValueError("Mixed digest sizes in manifest")
+
+            if index % BLOCK_SIZE == 0:
+                offsets.append(len(paths))
+                shared = 0
+            else:
+                shared = common_prefix(previous, path)
+
+            paths += encode_varint(shared)
+            paths += encode_varint(len(path) - shared)
+            paths += path[shared:]
+            digests += digest
+            previous = path
+
+        return cls(len(digests) // digest_size if digest_size else 0,
+                   digest_size or 0, offsets, bytes(digests), bytes(paths))
+
+    @classmethod
+    def load(cls, path):
+        """Loads the manifest memory mapping the file at the given path."""
+        with open(path, 'rb') as manifest_file:
+            buffer = mmap.mmap(manifest_file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, digest_size, count, blocks = HEADER.unpack_from(
+                buffer)
+        except struct.error:
+            raise ValueError("Invalid manifest file %s" % path)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Invalid manifest file %s" % path)
+
+        view = memoryview(buffer)
+        start = HEADER.size
+        digests_start = start + blocks * 8
+        paths_start = digests_start + count * digest_size
+
+        if sys.byteorder == 'little':
+            offsets = view[start:digests_start].cast('Q')
+        else:
+            offsets = array('Q', view[start:digests_start])
+            offsets.byteswap()
+
+        manifest = cls(count, digest_size, offsets,
+                       view[digests_start:paths_start], view[paths_start:])
+        manifest._mmap = buffer
+
+        return manifest
+
+    def save(self, path):
+        """Saves the manifest into the file at the given path."""
+        offsets = array('Q', self._offsets)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        with open(path, 'wb') as manifest_file:
+            manifest_file.write(HEADER.pack(MAGIC, VERSION, self._digest_size,
+                                            self._count, len(offsets)))
+            manifest_file.write(offsets.tobytes())
+            manifest_file.write(self._digests)
+            manifest_file.write(self._paths)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return (path for path, _ in self._entries())
+
+    def __getitem__(self, path):
+        key = path.encode('utf8', 'surrogateescape')
+        block = bisect_right(BlockKeys(self), key) - 1
+
+        if block >= 0:
+            for index, entry in self._block_entries(block):
+                if entry == key:
+                    return self._digest(index)
+                elif entry > key:
+                    break
+
+        raise KeyError(path)
+
+    def items(self):
+        return ManifestItems(self)
+
+    def _entries(self):
+        """Iterates over the (path, index) tuples in sorted order."""
+        for block in range(len(self._offsets)):
+            for index, path in self._block_entries(block):
+                yield path.decode('utf8', 'surrogateescape'), index
+
+    def _block_entries(self, block):
+        """Iterates over the (index, encoded path) tuples of the block."""
+        path = b''
+        position = self._offsets[block]
+        start = block * BLOCK_SIZE
+
+        for index in range(start, min(start + BLOCK_SIZE, self._count)):
+            shared, position = decode_varint(self._paths, position)
+            length, position = decode_varint(self._paths, position)
+            path = path[:shared] + bytes(self._paths[position:position+length])
+            position += length
+
+            yield index, path
+
+    def _block_key(self, block):
+        """Returns the first encoded path of the block."""
+        position = self._offsets[block]
+        _, position = decode_varint(self._paths, position)
+        length, position = decode_varint(self._paths, position)
+
+        return bytes(self._paths[position:position + length])
+
+    def _digest(self, index):
+        start = index * self._digest_size
+
+        return bytes(self._digests[start:start + self._digest_size]).hex()
+
+
+class ManifestItems(ItemsView):
+    """Iterates over the manifest entries decoding them sequentially."""
+    def __iter__(self):
+        manifest = self._mapping
+
+        return ((path, manifest._digest(index))
+                for path, index in manifest._entries())
+
+
+class BlockKeys:
+    """Sequence of the first paths of the manifest blocks for bisecting."""
+    def __init__(self, manifest):
+        self._manifest = manifest
+
+    def __len__(self):
+        return len(self._manifest._offsets)
+
+    def __getitem__(self, block):
+        return self._manifest._block_key(block)
+
+
+def common_prefix(string0, string1):
+    """Returns the length of the common prefix of the two strings."""
+    length = min(len(string0), len(string1))
+
+    for index in range(length):
+        if string0[index] != string1[index]:
+            return index
+
+    return length
+
+
+def encode_varint(number):
+    encoded = bytearray()
+
+    while number > 0x7f:
+        encoded.append((number & 0x7f) | 0x80)
+        number >>= 7
+    encoded.append(number)
+
+    return encoded
+
+
+def decode_varint(buffer, position):
+    """Returns the decoded number and the position following it."""
+    number = shift = 0
+
+    while True:
+        byte = buffer[position]
+        number |= (byte & 0x7f) << shift
+        position += 1
+        shift += 7
+
+        if not byte & 0x80:
+            return number, position
+
+
+BLOCK_SIZE = 16
+MAGIC = b'VMIM'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQ')
@@ -0,0 +1,243 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Content addressed storage for the files extracted from disk images."""
+
+
+import os
+import gzip
+import sqlite3
+import hashlib
+from tempfile import NamedTemporaryFile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ContentStore:
+    """Stores files by their SHA1 hash.
+
+    The files are laid out in fan-out directories (ab/cd/abcd...)
+    and can be compressed with gzip or zstd (requires zstandard).
+    Files already present in the store are not written again.
+
+    An SQLite index keeps track of the stored files
+    and counts the references to each of them.
+    Releasing the last reference deletes the file.
+
+    """
+    def __init__(self, path, compression=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unsupported compression %s" % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError("zstd compression requires zstandard package")
+
+        self.path = path
+        self.compression = compression
+        self._index = None
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def __getstate__(self):
+        """The index connection cannot be shared across processes."""
+        state = self.__dict__.copy()
+        state['_index'] = None
+
+        return state
+
+    def __contains__(self, sha1):
+        return self._lookup(sha1) is not None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = sqlite3.connect(
+                os.path.join(self.path, INDEX_NAME), timeout=60)
+            self._index.execute(INDEX_SCHEMA)
+
+        return self._index
+
+    def object_path(self, sha1):
+        """Returns the path of the stored file with the given hash."""
+        compression = self._lookup(sha1)
+        if compression is None:
+            raise KeyError(sha1)
+
+        return self._object_path(sha1, compression)
+
+    def add(self, sha1, fileobj):
+        """Stores the content of the file object with the given hash.
+
+        If already stored, only its reference count is incremented.
+        The content hash is verified while storing it.
+
+        Returns the path of the stored file.
+
+        """
+        if self.reference(sha1):
+            return self.object_path(sha1)
+
+        path = self._object_path(sha1, self.compression)
+        directory = os.path.dirname(path)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with NamedTemporaryFile(dir=directory, delete=False) as tempfile:
+            try:
+                digest = self._write(fileobj, tempfile)
+                if digest != sha1.lower():
+                    raise RuntimeError("Content hash mismatch %s" % digest)
+            except BaseException:
+                os.remove(tempfile.name)
+                raise
+
+        os.replace(tempfile.name, path)
+
+        with self.index:
+            self.index.execute(
+                """INSERT INTO objects VALUES (?, ?, 1) ON CONFLICT(sha1)
+                   DO UPDATE SET refcount = refcount + 1""",
+                (sha1.lower(), self.compression or ''))
+
+        return path
+
+    def reference(self, sha1):
+        """Increments the reference count of the file with the given hash.
+
+        Returns False if the file is not stored.
+
+        """
+        with self.index:
+            cursor = self.index.execute(
+                "UPDATE objects SET refcount = refcount + 1 WHERE sha1 = ?",
+                (sha1.lower(), ))
+
+        return cursor.rowcount > 0
+
+    def release(self, sha1):
+        """Decrements the reference count of the file with the given hash.
+
+        The file is deleted once no reference is left.
+
+        """
+        compression = self._lookup(sha1)
+        if compression is None:
+            raise KeyError(sha1)
+
+        with self.index:
+            self.index.execute(
+                "UPDATE objects SET refcount = refcount - 1 WHERE sha1 = ?",
+                (sha1.lower(), ))
+            deleted = self.index.execute(
+                "DELETE FROM objects WHERE sha1 = ? AND refcount <= 0",
+                (sha1.lower(), )).rowcount
+
+        if deleted:
+            os.remove(self._object_path(sha1, compression))
+
+    def open(self, sha1):
+        """Returns a file object reading the content of the stored file."""
+        compression = self._lookup(sha1)
+        if compression is None:
+            raise KeyError(sha1)
+
+        path = self._object_path(sha1, compression)
+
+        if compression == 'gzip':
+            return gzip.open(path, 'rb')
+        elif compression == 'zstd':
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        else:
+            return open(path, 'rb')
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _lookup(self, sha1):
+        """Returns the compression of the stored file, None if missing.
+
+        Uncompressed files are reported with an empty string.
+
+        """
+        row = self.index.execute(
+            "SELECT compression FROM objects WHERE sha1 = ?",
+            (sha1.lower(), )).fetchone()
+
+        return row[0] if row is not None else None
+
+    def _object_path(self, sha1, compression):
+        sha1 = sha1.lower()
+
+        return os.path.join(self.path, sha1[:2], sha1[2:4],
+                            sha1 + COMPRESSIONS[compression or None])
+
+    def _write(self, source, destination):
+        """Copies the source into the destination file compressing it.
+
+        Returns the SHA1 of the content.
+
+        """
+        digest = hashlib.sha1()
+
+        if self.compression == 'gzip':
+            writer = gzip.GzipFile(fileobj=destination, mode='wb')
+        elif self.compression == 'zstd':
+            writer = zstandard.ZstdCompressor().stream_writer(
+                destination, closefd=False)
+        else:
+            writer = None
+
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            (writer or destination).write(chunk)
+
+        if writer is not None:
+            writer.close()
+
+        return digest.hexdigest()
+
+
+def store_file(store, sha1, path):
+    """Stores the file at the given path, returns the stored file path."""
+    with open(path, 'rb') as source:
+        return store.add(sha1, source)
+
+
+CHUNK_SIZE = 1024 * 1024
+INDEX_NAME = 'index.sqlite'
+INDEX_SCHEMA = """CREATE TABLE IF NOT EXISTS objects
+                  (sha1 TEXT PRIMARY KEY, compression TEXT, refcount INTEGER)"""
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
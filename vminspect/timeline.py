@@ -43,8 +43,9 @@ from vminspect.usnjrnl import CorruptedUsnRecord, usn_journal
 
 
 class FSTimeline:
-    def __init__(self, disk):
+    def __init__(self, disk, pool=None):
         self._disk = disk
+        self._pool = pool
         self._filesystem = None
         self._filetype_cache = {}
         self._checksum_cache = {}
@@ -52,7 +53,7 @@ class FSTimeline:
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self._filesystem = FileSystem(self._disk)
+        self._filesystem = FileSystem(self._disk, pool=self._pool)
         self._filesystem.mount()
 
         return self
@@ -98,7 +99,7 @@ class FSTimeline:
         """Walks through the filesystem content."""
         self.logger.debug("Parsing File System content.")
 
-        root_partition = self._filesystem.inspect_get_roots()[0]
+        root_partition = self._filesystem.inspection.root
 
         yield from self._root_dirent()
 
@@ -133,8 +134,8 @@ class NTFSTimeline(FSTimeline):
       https://github.com/noxdafox/libguestfs/tree/forensics
 
     """
-    def __init__(self, disk):
-        super().__init__(disk)
+    def __init__(self, disk, pool=None):
+        super().__init__(disk, pool=pool)
 
     def __enter__(self):
         super().__enter__()
@@ -174,7 +175,7 @@ class NTFSTimeline(FSTimeline):
 
     def _read_journal(self):
         """Extracts the USN journal from the disk and parses its content."""
-        root = self._filesystem.inspect_get_roots()[0]
+        root = self._filesystem.inspection.root
         inode = self._filesystem.stat('C:\\$Extend\\$UsnJrnl')['ino']
 
         with NamedTemporaryFile(buffering=0) as tempfile:
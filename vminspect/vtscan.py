@@ -35,7 +35,7 @@ import requests
 from collections import namedtuple
 from itertools import chain, islice
 
-from vminspect.filesystem import FileSystem
+from vminspect.filesystem import FileSystem, hash_filesystem
 
 
 VTReport = namedtuple('VTReport', ('path', 'hash', 'detections'))
@@ -48,12 +48,16 @@ class VTScanner:
 
     disk must contain the path of a valid disk image.
     apikey must be a valid VT API key.
+    pool is an optional AppliancePool the disk is mounted on.
+    cache is an optional ManifestCache the disk hashes are loaded from.
 
     The attribute batchsize controls the amount of object per VT query.
 
     """
-    def __init__(self, disk, apikey):
+    def __init__(self, disk, apikey, pool=None, cache=None):
         self._disk = disk
+        self._pool = pool
+        self._cache = cache
         self._apikey = apikey
         self._filesystem = None
         self.batchsize = 1
@@ -61,7 +65,7 @@ class VTScanner:
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self._filesystem = FileSystem(self._disk)
+        self._filesystem = FileSystem(self._disk, pool=self._pool)
         self._filesystem.mount()
 
         return self
@@ -76,7 +80,7 @@ class VTScanner:
     def apikey(self):
         return self._apikey
 
-    def scan(self, filetypes=None):
+    def scan(self, filetypes=None, file_filter=None):
         """Iterates over the content of the disk and queries VirusTotal
         to determine whether it's malicious or not.
 
@@ -84,6 +88,9 @@ class VTScanner:
         If given, only the files which type will match with one or more of
         the given patterns will be queried against VirusTotal.
 
+        file_filter is an optional FileFilter selecting the files
+        to be hashed and queried.
+
         For each file which is unknown by VT or positive to any of its engines,
         the method yields a namedtuple:
 
@@ -96,10 +103,18 @@ class VTScanner:
 
         """
         self.logger.debug("Scanning FS content.")
-        checksums = self.filetype_filter(self._filesystem.checksums('/'),
-                                         filetypes=filetypes)
+        if self._cache is not None or file_filter is not None:
+            checksums = hash_filesystem(self._filesystem, cache=self._cache,
+                                        file_filter=file_filter).items()
+        else:
+            checksums = self._filesystem.checksums('/')
+
+        if filetypes is not None:
+            # the FS cannot be queried while the checksums are streamed
+            checksums = self.filetype_filter(list(checksums),
+                                             filetypes=filetypes)
 
-        self.logger.debug("Querying %d objects to VTotal.", len(checksums))
+        self.logger.debug("Querying objects to VTotal.")
 
         for files in chunks(checksums, size=self.batchsize):
             files = dict((reversed(e) for e in files))
@@ -44,17 +44,19 @@ class VulnScanner:
 
     disk must contain the path of a valid disk image.
     url must be a valid URL to a REST vulnerability service.
+    pool is an optional AppliancePool the disk is mounted on.
 
     """
-    def __init__(self, disk, url):
+    def __init__(self, disk, url, pool=None):
         self._disk = disk
+        self._pool = pool
         self._filesystem = None
         self._url = url.rstrip('/')
         self.logger = logging.getLogger(
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self._filesystem = FileSystem(self._disk)
+        self._filesystem = FileSystem(self._disk, pool=self._pool)
         self._filesystem.mount()
 
         return self
@@ -112,7 +114,7 @@ class VulnScanner:
     def applications(self):
         return (Application(a['app2_name'], a['app2_version'])
                 for a in self._filesystem.inspect_list_applications2(
-                        self._filesystem._root))
+                        self._filesystem.inspection.root))
 
 
 def lookup_vulnerabilities(app_version, vulnerabilities):
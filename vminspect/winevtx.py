@@ -45,14 +45,15 @@ class WinEventLog:
     Allows to retrieve the Events contained within Windows Event Log files.
 
     """
-    def __init__(self, disk):
+    def __init__(self, disk, pool=None):
         self._disk = disk
+        self._pool = pool
         self._filesystem = None
         self.logger = logging.getLogger(
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self._filesystem = FileSystem(self._disk)
+        self._filesystem = FileSystem(self._disk, pool=self._pool)
         self._filesystem.mount()
 
         return self
@@ -33,7 +33,9 @@
 
 import ntpath
 import codecs
-from collections import namedtuple
+import hashlib
+from functools import total_ordering
+from collections.abc import Sequence
 from datetime import datetime, timedelta
 
 try:
@@ -86,37 +88,121 @@ class RegistryHive(Hivex):
         """Sets the Registry Root Key."""
         self._rootkey = key
 
-    def keys(self):
+    def keys(self, raw=False):
         """Iterates over the hive's keys.
 
-        Yields WinRegKey namedtuples containing:
+        Yields WinRegKey objects containing:
 
             path: path of the key "RootKey\\Key\\..."
             timestamp: date and time of last modification
             values: list of values (("ValueKey", "ValueType", ValueValue), ... )
 
+        Timestamp and values are parsed on first access.
+        If raw is True, binary and unidentified values are returned as bytes
+        instead of base64 encoded strings.
+
         """
         for node in self.node_children(self.root()):
-            yield from self._visit_registry(node, self._rootkey)
+            yield from self._visit_registry(node, self._rootkey, raw)
+
+    def subtree_keys(self, node, path, raw=False):
+        """Iterates over the keys of the subtree rooted at the given node.
+
+        path is the path of the node parent key.
+
+        Yields WinRegKey objects as keys().
+
+        """
+        yield from self._visit_registry(node, path, raw)
+
+    def subtree_paths(self, node, path):
+        """Iterates over the paths of the keys of the subtree
+        rooted at the given node without parsing their values.
+
+        path is the path of the node parent key.
 
-    def _visit_registry(self, node, path):
+        """
         path = ntpath.join(path, self.node_name(node))
-        values = (self._parse_value(value) for value in self.node_values(node))
-        timestamp = (datetime(1601, 1, 1) + timedelta(
+
+        yield path
+
+        for child in self.node_children(node):
+            yield from self.subtree_paths(child, path)
+
+    def key_values(self, node, raw=False):
+        """Returns the parsed values of the given key node.
+
+        If raw is True, binary and unidentified values are returned as bytes.
+
+        """
+        return tuple(self._parse_value(value, raw)
+                     for value in self.node_values(node))
+
+    def key_timestamp(self, node):
+        """Returns the date and time of last modification of the key node."""
+        return (datetime(1601, 1, 1) + timedelta(
             microseconds=(self.node_timestamp(node) / 10))).isoformat(' ')
 
-        yield WinRegKey(path, timestamp, tuple(values))
+    def node_digests(self):
+        """Computes the Merkle digests of the hive's keys.
+
+        Returns a dictionary {node: (subtree_digest, values_digest)}.
+
+        The values digest covers the raw type and data of the key values.
+        The subtree digest covers the key name, its values digest
+        and the subtree digests of its children.
+        Timestamps are not included.
+
+        """
+        digests = {}
+
+        self._digest_node(self.root(), digests)
+
+        return digests
+
+    def _digest_node(self, node, digests):
+        values = hashlib.sha1()
+        for entry in sorted(self._value_entry(v)
+                            for v in self.node_values(node)):
+            values.update(entry)
+
+        children = sorted((self.node_name(child).encode('utf8', 'replace'),
+                           self._digest_node(child, digests))
+                          for child in self.node_children(node))
+
+        subtree = hashlib.sha1(self.node_name(node).encode('utf8', 'replace'))
+        subtree.update(values.digest())
+        for name, digest in children:
+            subtree.update(hashlib.sha1(name).digest() + digest)
+
+        digests[node] = subtree.digest(), values.digest()
+
+        return digests[node][0]
+
+    def _value_entry(self, value):
+        """Returns the digest of the raw value name, type and data."""
+        vtype, data = self.value_value(value)
+        name = self.value_key(value).encode('utf8', 'replace')
+
+        return hashlib.sha1(b'%d:%d:%s%s' % (len(name), vtype,
+                                             name, data)).digest()
+
+    def _visit_registry(self, node, path, raw=False):
+        path = ntpath.join(path, self.node_name(node))
+
+        yield WinRegKey(path, self, node, raw=raw)
 
         for child in self.node_children(node):
-            yield from self._visit_registry(child, path)
+            yield from self._visit_registry(child, path, raw)
 
-    def _parse_value(self, value):
+    def _parse_value(self, value, raw=False):
         vtype = self.value_type(value)[0]
         value_type = VALUE_TYPES.get(vtype, 'UNIDENTIFIED')
+        binary = self._raw_data if raw else self._value_data
         try:
-            value_data = self._types_map.get(vtype, self._value_data)(value)
+            value_data = self._types_map.get(vtype, binary)(value)
         except RuntimeError:
-            value_data = self._value_data(value)
+            value_data = binary(value)
 
         return self.value_key(value), value_type, value_data
 
@@ -125,6 +211,83 @@ class RegistryHive(Hivex):
         return codecs.decode(
             codecs.encode(self.value_value(value)[1], 'base64'), 'utf8')
 
+    def _raw_data(self, value):
+        return self.value_value(value)[1]
+
+
+@total_ordering
+class WinRegKey(Sequence):
+    """WinRegKey class.
+
+    Registry key yielded by RegistryHive.keys().
+
+    The timestamp and values of the key are parsed from the hive
+    on first access only, walking the hive for the paths is cheap.
+
+    It behaves as the (path, timestamp, values) namedtuple it replaces:
+    it can be unpacked, indexed, compared and converted via _asdict().
+    Being lazy, it is not a tuple: use tuple(key) or key._asdict()
+    to serialize it.
+
+    """
+    __slots__ = ('path', '_hive', '_node', '_raw', '_timestamp', '_values')
+    _fields = ('path', 'timestamp', 'values')
+
+    def __init__(self, path, hive, node, raw=False):
+        self.path = path
+        self._hive = hive
+        self._node = node
+        self._raw = raw
+        self._timestamp = None
+        self._values = None
+
+    @property
+    def timestamp(self):
+        """Date and time of last modification of the key."""
+        if self._timestamp is None:
+            self._timestamp = self._hive.key_timestamp(self._node)
+
+        return self._timestamp
+
+    @property
+    def values(self):
+        """Values of the key (("ValueKey", "ValueType", ValueValue), ...)."""
+        if self._values is None:
+            self._values = self._hive.key_values(self._node, raw=self._raw)
+
+        return self._values
+
+    def _asdict(self):
+        """Returns a dictionary mapping the field names to their values."""
+        return dict(zip(self._fields, self))
+
+    def __getitem__(self, index):
+        return (self.path, self.timestamp, self.values)[index]
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        return iter((self.path, self.timestamp, self.values))
+
+    def __eq__(self, other):
+        if not isinstance(other, (WinRegKey, tuple)):
+            return NotImplemented
+
+        return tuple(self) == tuple(other)
+
+    def __lt__(self, other):
+        if not isinstance(other, (WinRegKey, tuple)):
+            return NotImplemented
+
+        return tuple(self) < tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return 'WinRegKey(path=%r, timestamp=%r, values=%r)' % tuple(self)
+
 
 def registry_root(path):
     """Guesses the registry root from the file name."""
@@ -149,9 +312,6 @@ def user_registries_path(fsroot, user):
     return (p.format(fsroot, user) for p in USER_REGISTRY_PATH)
 
 
-WinRegKey = namedtuple('WinRegKey', ('path', 'timestamp', 'values'))
-
-
 VALUE_TYPES = {
     hive_types.REG_NONE: 'REG_NONE',
     hive_types.REG_SZ: 'REG_SZ',